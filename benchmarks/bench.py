@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'source'))
+
+import numpy as np
+import pydicom
+
+import batch
+import cache
+import dcmindex
+import maskstore
+import threshold
+import synthetic
+
+
+class Stage():
+    # wall time, bytes and Python-visible peak memory (numpy included) of one
+    # stage; tracemalloc slows allocation down, so every call is timed first
+    # and then repeated under tracemalloc for the peak only
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.count = 0
+        self.nbytes = 0
+        self.peak = 0
+
+    def measure(self, fn, *args):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        self.seconds += time.perf_counter() - t0
+        self.count += 1
+        tracemalloc.start()
+        fn(*args)
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        return result
+
+    def report(self):
+        return {'images': self.count, 'seconds': round(self.seconds, 6),
+                'images_per_s': round(self.count / self.seconds, 3) if self.seconds else None,
+                'mb_per_s': round(self.nbytes / self.seconds / 1e6, 3) if self.seconds and self.nbytes else None,
+                'peak_mb': round(self.peak / 1e6, 3)}
+
+
+def bench_cohort(root, tmp):
+    stages = {}
+
+    def stage(name):
+        return stages.setdefault(name, Stage(name))
+
+    headers = stage('scan').measure(batch.scan, root)
+    stage('scan').count = len(headers)
+    index_path = Path(tmp) / 'headers.sqlite'
+    with dcmindex.HeaderIndex(index_path) as index:
+        batch.scan(root, index)
+    with dcmindex.HeaderIndex(index_path) as index:
+        stage('scan_indexed').count = len(stage('scan_indexed').measure(batch.scan, root, index))
+
+    raws = []
+    for h in headers:
+        raws.append(stage('decode').measure(lambda: pydicom.dcmread(h.path).pixel_array))
+        stage('decode').nbytes += os.path.getsize(h.path)
+
+    try:
+        from skimage.filters import threshold_otsu
+    except ImportError:
+        threshold_otsu = None
+    deviation = []
+    mismatches = 0
+    for h, raw in zip(headers, raws):
+        bin = stage('threshold').measure(threshold.mask, raw)
+        stage('threshold').nbytes += raw.nbytes
+        if threshold_otsu is not None and threshold.threshold(raw) != threshold_otsu(raw):
+            mismatches += 1
+        approx = stage('threshold_step4').measure(threshold.mask, raw, 'otsu', 4)
+        area = stage('area').measure(lambda: np.count_nonzero(bin) * h.spacing_x * h.spacing_y)
+        deviation.append(abs(np.count_nonzero(approx) * h.spacing_x * h.spacing_y - area) / area)
+
+        stage('mask_save').measure(batch.save_mask, bin, (h.spacing_x, h.spacing_y),
+                                   Path(tmp) / 'masks' / h.patient_id / h.accession, f'{h.projection}_{int(area)}mm2')
+
+    if maskstore.available():
+        with maskstore.MaskStore(Path(tmp) / 'masks.h5') as store:
+            for h, raw in zip(headers, raws):
+                bin = threshold.mask(raw)
+                stage('mask_store').measure(store.put, h, 0.0, cache.pack_mask(bin))
+
+    try:
+        import mammarea
+    except ImportError:
+        mammarea = None
+    if mammarea is not None:
+        for h in headers:
+            ds = pydicom.dcmread(h.path)
+            mammarea.pixels.decode(ds)
+            # a fresh Drawable per pass, so both build the display pyramid
+            stage('display').measure(lambda: mammarea.Drawable(ds).get_drawable())
+
+    report = {name: st.report() for name, st in stages.items()}
+    if threshold_otsu is not None:
+        report['threshold']['skimage_mismatches'] = mismatches
+    report['threshold_step4']['max_area_deviation'] = float(max(deviation)) if deviation else None
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the MammArea pipeline stages on a synthetic cohort')
+    parser.add_argument('--count', type=int, default=8, help='images per cohort')
+    parser.add_argument('--sizes', default='small', help='comma separated rowsxcols or presets: ' + ', '.join(synthetic.SIZES))
+    parser.add_argument('--syntaxes', default='explicit,rle', help='comma separated: ' + ', '.join(synthetic.SYNTAXES))
+    parser.add_argument('--out', default='benchmark.json', help='JSON report (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = {'python': sys.version.split()[0], 'numpy': np.__version__, 'pydicom': pydicom.__version__,
+               'platform': platform.platform(), 'cpus': os.cpu_count(), 'count': args.count, 'runs': []}
+    for size in args.sizes.split(','):
+        for syntax in args.syntaxes.split(','):
+            with tempfile.TemporaryDirectory() as tmp:
+                root = Path(tmp) / 'cohort'
+                synthetic.generate(root, args.count, size, syntax, args.seed)
+                print(f'{size} {syntax}', file=sys.stderr)
+                run = {'size': size, 'syntax': syntax, 'stages': bench_cohort(root, tmp)}
+            results['runs'].append(run)
+            for name, stage in run['stages'].items():
+                print(f'  {name:16s} {stage["images_per_s"]} img/s  peak {stage["peak_mb"]} MB', file=sys.stderr)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'source'))
+
+import scanner
+
+
+def make_tree(root, depth=3, width=3, files=2):
+    # width**depth leaf folders; every folder, inner or leaf, holds a few files
+    # so leaves and their parents report in every possible order
+    def fill(folder, level):
+        os.makedirs(folder, exist_ok=True)
+        for i in range(files):
+            (Path(folder) / f'f{i}.bin').write_bytes(b'\0' * (i + 1))
+        if level < depth:
+            for i in range(width):
+                fill(Path(folder) / f'd{i}', level + 1)
+    fill(Path(root), 0)
+
+
+def expected(root):
+    return sorted(os.path.join(folder, name) for folder, _, names in os.walk(root) for name in names)
+
+
+def walk(root, delay):
+    # a consumer that sleeps after each file lets the listing threads finish
+    # out of order, which is when lost folders used to show up
+    w = scanner.Walk(root)
+    paths = []
+    for path, _ in w:
+        if delay:
+            time.sleep(delay)
+        paths.append(path)
+    return sorted(paths), w.found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that scanner.Walk lists the same files as os.walk')
+    parser.add_argument('--runs', type=int, default=20, help='walks per consumer speed')
+    parser.add_argument('--delay', type=float, default=0.002, help='seconds the slow consumer waits per file')
+    parser.add_argument('--root', default=None, help='walk this folder instead of a generated nested tree')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.root
+        if root is None:
+            root = os.path.join(tmp, 'tree')
+            make_tree(root)
+        want = expected(root)
+        failed = 0
+        for delay in (0, args.delay):
+            for _ in range(args.runs):
+                got, found = walk(root, delay)
+                if got != want or found != len(want):
+                    failed += 1
+                    print(f'delay {delay}: {len(got)} of {len(want)} files (found {found})', file=sys.stderr)
+    print(f'{2 * args.runs - failed} of {2 * args.runs} walks listed all {len(want)} files', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
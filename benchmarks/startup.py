@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+SOURCE = Path(__file__).resolve().parent.parent / 'source'
+# libraries that must only be imported by the features that need them
+DEFERRED = ['pydicom', 'nibabel', 'pandas', 'PIL', 'skimage', 'h5py', 'scipy']
+
+# runs in a fresh interpreter: time from the first import to the initial window being painted
+CHILD = '''
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {source!r})
+import mammarea
+t1 = time.perf_counter()
+app = mammarea.QtWidgets.QApplication(sys.argv)
+window = mammarea.MainWindow(app.primaryScreen().availableGeometry())
+window.show()
+app.processEvents()
+t2 = time.perf_counter()
+print(json.dumps({{'import_s': t1 - t0, 'window_s': t2 - t0,
+                  'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+'''
+
+
+def measure(runs=5):
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    code = CHILD.format(source=str(SOURCE), deferred=DEFERRED)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {'runs': runs,
+            'import_s': statistics.median(s['import_s'] for s in samples),
+            'window_s': statistics.median(s['window_s'] for s in samples),
+            'loaded': sorted({m for s in samples for m in s['loaded']})}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure how long mammarea.py takes to show its first window')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to start (median is reported)')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='fail if the median time to the first window exceeds this many seconds')
+    parser.add_argument('--out', default=None, help='also write the result as JSON')
+    args = parser.parse_args(argv)
+
+    result = measure(args.runs)
+    print(f'import {result["import_s"]:.3f} s, first window {result["window_s"]:.3f} s', file=sys.stderr)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    failed = False
+    if result['loaded']:
+        print(f'imported at start up: {", ".join(result["loaded"])}', file=sys.stderr)
+        failed = True
+    if args.budget is not None and result['window_s'] > args.budget:
+        print(f'over the {args.budget} s budget', file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+MG_SOP_CLASS = '1.2.840.10008.5.1.4.1.1.1.2'
+# rows x columns of common full-field digital mammography detectors
+SIZES = {'small': (1024, 832), 'ge': (2294, 1914), 'siemens': (3328, 2560), 'hologic': (4096, 3328)}
+SYNTAXES = {'explicit': ExplicitVRLittleEndian, 'rle': RLELossless}
+# OB values are padded to an even length, so odd ones (b'MLO') would be read
+# back with a trailing NUL; CC and ML (mediolateral) are both two bytes
+PROJECTIONS = [b'CC', b'ML']
+
+
+def parse_size(text):
+    if text in SIZES:
+        return SIZES[text]
+    rows, cols = text.lower().split('x')
+    return int(rows), int(cols)
+
+
+def breast_image(rows, cols, rng, bits=12):
+    # a noisy half-ellipse on a dark background, attached to the chest wall on the left
+    y, x = np.ogrid[:rows, :cols]
+    cy = rows / 2 + rng.uniform(-0.05, 0.05) * rows
+    ry = rows * rng.uniform(0.35, 0.45)
+    rx = cols * rng.uniform(0.55, 0.8)
+    inside = ((y - cy) / ry) ** 2 + (x / rx) ** 2 <= 1
+    top = 2 ** bits - 1
+    img = rng.normal(top * 0.05, top * 0.01, (rows, cols)).astype(np.float32)
+    tissue = top * (0.45 + 0.25 * (1 - x / cols)) + rng.normal(0, top * 0.04, (rows, cols))
+    img[inside] = np.broadcast_to(tissue, (rows, cols))[inside]
+    return np.clip(img, 0, top).astype(np.uint16)
+
+
+def mg_dataset(pixels, patient, accession, projection, spacing=0.07, syntax='explicit'):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MG_SOP_CLASS
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = MG_SOP_CLASS
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MG'
+    ds.PatientID = patient
+    ds.AccessionNumber = accession
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.add_new((0x0045, 0x101b), 'OB', projection)
+    ds.add_new((0x0018, 0x1164), 'DS', [spacing, spacing])
+    ds.Rows, ds.Columns = pixels.shape[-2:]
+    if pixels.ndim == 3:
+        ds.NumberOfFrames = pixels.shape[0]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixels.tobytes()
+    if syntax != 'explicit':
+        ds.compress(SYNTAXES[syntax], pixels)
+    return ds
+
+
+def volume(rows, cols, frames, rng):
+    # tomosynthesis-like stack: the breast outline shrinks towards both ends
+    stack = np.empty((frames, rows, cols), dtype=np.uint16)
+    for i in range(frames):
+        frame = breast_image(rows, cols, rng)
+        edge = int(cols * 0.3 * abs(i - (frames - 1) / 2) / max(frames, 1))
+        if edge:
+            frame[:, cols - edge:] = frame[0, -1]
+        stack[i] = frame
+    return stack
+
+
+def generate(root, count, size='small', syntax='explicit', seed=0, frames=1):
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+    rows, cols = parse_size(size)
+    paths = []
+    for i in range(count):
+        patient = f'SYN{i // 4:05d}'
+        accession = f'ACC{i // 4:05d}'
+        projection = PROJECTIONS[i % 2]
+        pixels = breast_image(rows, cols, rng) if frames <= 1 else volume(rows, cols, frames, rng)
+        ds = mg_dataset(pixels, patient, accession, projection, syntax=syntax)
+        folder = root / patient / accession
+        os.makedirs(folder, exist_ok=True)
+        # every other file has no extension, as in PACS exports
+        path = folder / (f'IM{i:05d}.dcm' if i % 2 == 0 else f'IM{i:05d}')
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic MG DICOM cohort')
+    parser.add_argument('out', help='output folder')
+    parser.add_argument('--count', type=int, default=16)
+    parser.add_argument('--size', default='small', help=f'rowsxcols or one of {", ".join(SIZES)}')
+    parser.add_argument('--syntax', choices=sorted(SYNTAXES), default='explicit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--frames', type=int, default=1, help='frames per object, >1 for tomosynthesis-like volumes')
+    args = parser.parse_args(argv)
+    paths = generate(args.out, args.count, args.size, args.syntax, args.seed, args.frames)
+    print(f'{len(paths)} files written to {args.out}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
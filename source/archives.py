@@ -0,0 +1,152 @@
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict, namedtuple
+
+import dcmindex
+
+SEP = '::'
+SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+PREAMBLE = 128
+HEAD_CHUNK = 1 << 16
+OPEN_ARCHIVES = 8
+
+# what HeaderIndex and PixelCache need from os.stat; members share the archive's
+MemberStat = namedtuple('MemberStat', ['st_size', 'st_mtime_ns'])
+
+
+def is_archive(path):
+    return str(path).lower().endswith(SUFFIXES)
+
+
+def is_member(path):
+    return SEP in str(path)
+
+
+def member_path(archive, name):
+    return f'{archive}{SEP}{name}'
+
+
+def split(path):
+    archive, _, name = str(path).partition(SEP)
+    return archive, name
+
+
+def exists(path):
+    return os.path.exists(split(path)[0])
+
+
+def stat(path):
+    s = os.stat(split(path)[0])
+    return MemberStat(s.st_size, s.st_mtime_ns)
+
+
+class _Archive():
+    # an open archive shared by the threads of one process; zip members can be
+    # read concurrently, tar members are read one at a time under the lock
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, 'r:*')
+
+    def open(self, name):
+        if self.zip is not None:
+            return self.zip.open(name)
+        with self.lock:
+            return io.BytesIO(self.tar.extractfile(name).read())
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+
+_open = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def open_member(path):
+    # a seekable binary stream over one member; the archive stays open (a few
+    # at a time per process) so its directory is not read again for every member
+    archive, name = split(path)
+    key = (archive, stat(path))
+    with _open_lock:
+        arc = _open.get(key)
+        if arc is None:
+            arc = _open[key] = _Archive(archive)
+            while len(_open) > OPEN_ARCHIVES:
+                _open.popitem(last=False)[1].close()
+        _open.move_to_end(key)
+    return arc.open(name)
+
+
+def _fingerprint(size, tag, head):
+    # the member size, the archive's own checksum or date for it and its first
+    # bytes, so the result cache sees a changed member without reading it whole
+    h = hashlib.blake2b(f'{size}:{tag}'.encode(), digest_size=16)
+    h.update(head)
+    return h.hexdigest()
+
+
+def _head(f, buf=b''):
+    # parses the header from the member's first bytes, reading more only while
+    # the buffer ends before the pixel data; members are never read backwards
+    import pydicom
+    buf += f.read(HEAD_CHUNK - len(buf))
+    while True:
+        stream = io.BytesIO(buf)
+        dcm = pydicom.dcmread(stream, stop_before_pixels=True, specific_tags=dcmindex.TAGS)
+        if stream.tell() < len(buf):
+            return dcm, buf
+        more = f.read(len(buf))
+        if not more:
+            return dcm, buf
+        buf += more
+
+
+def _header(path, f, name, size, tag):
+    start = f.read(PREAMBLE + 4)
+    if start[PREAMBLE:] != b'DICM' and not name.lower().endswith('.dcm'):
+        return None
+    try:
+        dcm, head = _head(f, start)
+    except Exception:
+        return dcmindex.unreadable(path)
+    fp = _fingerprint(size, tag, head[:HEAD_CHUNK]) if dcm.get('Modality') == 'MG' else None
+    return dcmindex.header_from_dataset(path, dcm, fp)
+
+
+def read_headers(archive):
+    # headers of every DICOM member, reading only the first bytes of each in
+    # archive order; compressed tars are decompressed once, front to back.
+    # A damaged or truncated archive keeps the members read before the damage
+    headers = []
+    try:
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as z:
+                for info in z.infolist():
+                    if info.is_dir():
+                        continue
+                    with z.open(info) as f:
+                        header = _header(member_path(archive, info.filename), f, info.filename,
+                                         info.file_size, info.CRC)
+                    if header is not None:
+                        headers.append(header)
+        else:
+            with tarfile.open(archive, 'r:*') as tar:
+                for info in tar:
+                    if not info.isfile():
+                        continue
+                    f = tar.extractfile(info)
+                    header = _header(member_path(archive, info.name), f, info.name, info.size, info.mtime)
+                    if header is not None:
+                        headers.append(header)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, OSError):
+        pass
+    return headers
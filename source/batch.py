@@ -0,0 +1,352 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import archives
+import cache
+import dcmindex
+import maskstore
+import pixels
+import scanner
+import shards
+import threshold
+import timing
+import writer
+
+COLUMNS = ['IDPACS', 'Accession Number', 'Projection', 'Area']
+FRAME_COLUMNS = ['IDPACS', 'Accession Number', 'Projection', 'Frame', 'Area']
+CACHE_DIR = Path(os.path.expanduser('~')) / '.MammAreaCache'
+INDEX_PATH = CACHE_DIR / 'headers.sqlite'
+RESULTS_PATH = CACHE_DIR / 'results.sqlite'
+# bump whenever a change to the pipeline can change an area or a mask
+ALGORITHM_VERSION = 1
+WORKER_PIXEL_CACHE = 64 << 20
+
+
+class Cancelled(Exception):
+    pass
+
+
+def check(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+def scan(root, index=None, progress=None, cancel=None, workers=scanner.WORKERS):
+    # every file below root is sniffed, not only *.dcm, and ZIP/TAR archives
+    # are read in place; headers are read in parallel and returned sorted by
+    # path so runs are reproducible. Folders are listed while headers are
+    # read, so the total reported to progress grows until listing is done
+    files = scanner.Walk(root)
+    headers = []
+    i = 0
+    try:
+        for path, header in scanner.iter_headers(files, index, workers, cancel):
+            if header.modality == 'MG':
+                headers.append(header)
+            if not archives.is_member(path):
+                i += 1
+                if progress is not None:
+                    progress(i, files.found)
+        check(cancel)
+        if index is not None:
+            index.forget_missing(root, archives.exists)
+    finally:
+        if index is not None:
+            index.commit()
+    headers.sort(key=lambda h: h.path)
+    return headers
+
+
+def save_mask(bin, vox_dims, folder, name, timings=timing.NULL):
+    # bin is a boolean mask: the PNG is 1-bit and the NIfTI uint8 (0/255)
+    import nibabel
+    from PIL import Image
+    os.makedirs(folder, exist_ok=True)
+    h, w = bin.shape
+    png = Path(folder) / f'{name}.png'
+    with timings.stage('save_png'):
+        Image.frombytes('1', (w, h), np.packbits(bin, axis=1).tobytes()).save(png)
+    x, y = vox_dims
+    affine = np.array([[x, 0, 0, 0],
+                       [0, y, 0, 0],
+                       [0, 0, 1, 0],
+                       [0, 0, 0, 1]])
+
+    mask = nibabel.Nifti1Image(np.multiply(bin.T, 255, dtype=np.uint8), affine=affine)
+    mask.set_sform(None, code=0)
+    mask.set_qform(None, code=0)
+    nii = Path(folder) / f'{name}.nii.gz'
+    with timings.stage('save_nifti'):
+        nibabel.save(mask, nii)
+    if timings is not timing.NULL:
+        timings.bytes_written += os.path.getsize(png) + os.path.getsize(nii)
+
+
+def make_row(header, area, frames=None):
+    row = {'IDPACS': header.patient_id, 'Accession Number': header.accession,
+           'Projection': header.projection, 'Area': np.round(area, 2)}
+    if frames is not None:
+        row['Frames'] = [dict(row, Frame=i, Area=np.round(a, 2)) for i, a in enumerate(frames)]
+    return row
+
+
+def algorithm_id(method='otsu', step=1):
+    if method == 'otsu' and step == 1:
+        return str(ALGORITHM_VERSION)
+    return f'{ALGORITHM_VERSION}-{method}-{step}'
+
+
+def frame_areas(header, method='otsu', step=1, timings=timing.NULL):
+    # streams a multi-frame (e.g. tomosynthesis) object one frame at a time,
+    # thresholding each frame on its own; returns the per-frame areas and the
+    # mask of the largest one, which is the only mask kept in memory
+    vox_dims = (header.spacing_x, header.spacing_y)
+    areas = []
+    best = None
+    for frame in pixels.iter_frames(header.path, timings):
+        with timings.stage('threshold'):
+            bin = threshold.mask(frame, method, step)
+        with timings.stage('area'):
+            areas.append(np.count_nonzero(bin) * vox_dims[0] * vox_dims[1])
+        if best is None or areas[-1] > areas[best[0]]:
+            best = (len(areas) - 1, bin)
+    return areas, best[1]
+
+
+def compute_area(header, save_dir=None, cached=None, keep_mask=False, method='otsu', step=1, timed=False):
+    # returns (area, packed mask or None, per-stage timings or None, per-frame
+    # areas or None); the area of a multi-frame object is that of its largest frame
+    if header.projection is None or header.spacing_x is None:
+        raise KeyError(f'{header.path}: missing projection or imager pixel spacing')
+    vox_dims = (header.spacing_x, header.spacing_y)
+    timings = timing.Timings() if timed else timing.NULL
+
+    frames = None
+    if cached is not None:
+        area, packed, frames = cached
+        bin = cache.unpack_mask(*packed)
+    elif (header.frames or 1) > 1:
+        frames, bin = frame_areas(header, method, step, timings)
+        area = max(frames)
+    else:
+        raw = pixels.load(header.path, timings)
+        with timings.stage('threshold'):
+            bin = threshold.mask(raw, method, step)
+        with timings.stage('area'):
+            area = np.count_nonzero(bin) * vox_dims[0] * vox_dims[1]
+    if save_dir is not None:
+        save_mask(bin, vox_dims, Path(save_dir) / header.patient_id / header.accession,
+                  f'{header.projection}_{int(area)}mm2', timings)
+    packed = None
+    if keep_mask and cached is None:
+        with timings.stage('pack'):
+            packed = cache.pack_mask(bin)
+    return area, packed, timings.as_dict(), frames
+
+
+def _init_worker(cache_bytes):
+    pixels.CACHE.max_bytes = cache_bytes
+
+
+def _compute(args):
+    return compute_area(*args)
+
+
+def _map(jobs, workers):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield _compute(job)
+        return
+    chunksize = max(1, min(16, len(jobs) // (workers * 4)))
+    # each worker decodes every image exactly once, so its pixel cache is kept small
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(WORKER_PIXEL_CACHE,))
+    try:
+        yield from pool.map(_compute, jobs, chunksize=chunksize)
+    finally:
+        # on early exit (cancel, error) queued images are dropped, not computed
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def run(headers, save_dir=None, workers=None, results=None, method='otsu', step=1, store=None, report=None):
+    # rows are yielded in the same order as headers, whatever the pool size;
+    # cached results and duplicate instances are not sent to the pool again.
+    # Masks for a store come back bit-packed and are written by this process.
+    version = algorithm_id(method, step)
+    keys = [cache.result_key(h, version) for h in headers]
+    need_mask = save_dir is not None or store is not None
+    keep_mask = store is not None or (results is not None and results.store_masks)
+    stage = report.stage if report is not None else timing.NULL.stage
+    done = {}
+    hits = {}
+    jobs = []
+    with stage('cache_lookup', len(headers)):
+        for h, key in zip(headers, keys):
+            if key in done or key in hits:
+                continue
+            hit = results.get(key, with_mask=need_mask) if results is not None else None
+            if hit is not None and save_dir is None:
+                done[key] = (hit[0], hit[2])
+                if store is not None:
+                    store.put(h, hit[0], hit[1])
+            else:
+                jobs.append((h, save_dir, hit, keep_mask, method, step, report is not None))
+                hits[key] = hit
+
+    computed = _map(jobs, workers)
+    try:
+        for h, key in zip(headers, keys):
+            if key not in done:
+                area, packed, timings, frames = next(computed)
+                done[key] = (area, frames)
+                if results is not None:
+                    results.put(key, area, packed, frames)
+                if store is not None:
+                    t0 = time.perf_counter()
+                    store.put(h, area, packed if packed is not None else hits[key][1])
+                    if timings is not None:
+                        timings['store'] = time.perf_counter() - t0
+                if report is not None:
+                    report.add_image(h.path, timings)
+            elif report is not None:
+                report.cached += 1
+            yield make_row(h, *done[key])
+    finally:
+        computed.close()
+        if results is not None:
+            results.commit()
+        if store is not None:
+            store.flush()
+
+
+def inputs_id(headers, save_dir=None, method='otsu', step=1, store=None):
+    store_path = store.path if store is not None else None
+    h = hashlib.blake2b(f'{algorithm_id(method, step)}:{save_dir}:{store_path}'.encode(), digest_size=16)
+    for header in headers:
+        h.update(f'{header.path}:{header.fingerprint}\n'.encode())
+    return h.hexdigest()
+
+
+def run_to_csv(headers, csv_path, save_dir=None, workers=None, results=None, progress=None,
+               method='otsu', step=1, cancel=None, store=None, report=None, frames_path=None):
+    # on Cancelled every row computed so far is already in the CSV and checkpoint;
+    # per-frame areas of multi-frame objects go to frames_path when given
+    def on_sync():
+        # the cache and mask store reach disk before the rows that rely on them
+        if results is not None:
+            results.commit()
+        if store is not None:
+            store.flush()
+
+    sidecar = (frames_path, FRAME_COLUMNS) if frames_path is not None else None
+    with writer.ResultWriter(csv_path, COLUMNS, inputs_id(headers, save_dir, method, step, store),
+                             on_sync=on_sync, sidecar=sidecar) as out:
+        start = out.done
+        if progress is not None:
+            progress(start, len(headers))
+        rows = run(headers[start:], save_dir, workers, results, method, step, store, report)
+        try:
+            for i, row in enumerate(rows):
+                if sidecar is not None:
+                    for frame in row.get('Frames', ()):
+                        out.write_sidecar(frame)
+                out.write(row)
+                if progress is not None:
+                    progress(start + i + 1, len(headers))
+                check(cancel)
+        finally:
+            rows.close()
+    return start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute MG breast areas without the GUI')
+    parser.add_argument('root', help='folder scanned recursively for DICOM files')
+    parser.add_argument('out', help='results folder (areas.csv and masks)')
+    parser.add_argument('--masks', action='store_true', help='save PNG and NIfTI masks')
+    parser.add_argument('--mask-store', default=None, help='write all masks into this single HDF5 file (needs h5py)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--index', default=str(INDEX_PATH), help='header index database (default: %(default)s)')
+    parser.add_argument('--no-index', action='store_true', help='read every header from disk')
+    parser.add_argument('--scan-workers', type=int, default=scanner.WORKERS, help='threads reading headers (default: %(default)s)')
+    parser.add_argument('--cache', default=str(RESULTS_PATH), help='result cache database (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every image')
+    parser.add_argument('--cache-masks', action='store_true', help='also keep bit-packed masks in the result cache')
+    parser.add_argument('--method', choices=sorted(threshold.METHODS), default='otsu', help='thresholding method')
+    parser.add_argument('--step', type=int, default=1,
+                        help='estimate the threshold from every STEP-th row and column (default: full resolution)')
+    parser.add_argument('--excel', action='store_true', help='also export areas.xlsx at the end')
+    parser.add_argument('--parquet', action='store_true', help='also export areas.parquet at the end')
+    parser.add_argument('--frames', action='store_true',
+                        help='also write per-frame areas of multi-frame (tomosynthesis) objects to frames.csv')
+    parser.add_argument('--shard-index', type=int, default=0, help='which shard of the cohort to compute (0-based)')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='split the cohort by SOPInstanceUID into this many shards, each written to its own '
+                             'folder below out; combine them with shards.py')
+    parser.add_argument('--report', action='store_true', help='write per-image and per-stage timings to run_report.json/.csv')
+    args = parser.parse_args(argv)
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error(f'--shard-index must be in 0..{args.shard_count - 1}')
+
+    report = timing.RunReport() if args.report else None
+    stage = report.stage if report is not None else timing.NULL.stage
+    with stage('scan'):
+        if args.no_index:
+            headers = scan(args.root, workers=args.scan_workers)
+        else:
+            with dcmindex.HeaderIndex(args.index) as index:
+                headers = scan(args.root, index, workers=args.scan_workers)
+    if len(headers) == 0:
+        print('No MG Dicom files found!', file=sys.stderr)
+        return 1
+    out = Path(args.out)
+    store_path = args.mask_store
+    sharded = args.shard_count > 1
+    if sharded:
+        cohort = headers
+        headers = shards.select(cohort, args.shard_index, args.shard_count)
+        out = out / shards.folder_name(args.shard_index, args.shard_count)
+        if store_path:
+            store_path = shards.store_path(store_path, args.shard_index, args.shard_count)
+        print(f'Shard {args.shard_index}/{args.shard_count}: {len(headers)} of {len(cohort)} images', file=sys.stderr)
+    os.makedirs(out, exist_ok=True)
+    if sharded:
+        shards.write_manifest(out, cohort, headers, args.shard_index, args.shard_count)
+    results = None if args.no_cache else cache.ResultCache(args.cache, args.cache_masks)
+    store = maskstore.MaskStore(store_path) if store_path else None
+    progress = lambda i, l: print(f'\r{i}/{l}', end='', file=sys.stderr)
+    try:
+        with stage('calc', len(headers)):
+            resumed = run_to_csv(headers, out / 'areas.csv', out if args.masks else None, args.workers, results,
+                                 progress, args.method, args.step, store=store, report=report,
+                                 frames_path=out / 'frames.csv' if args.frames else None)
+        print(file=sys.stderr)
+    finally:
+        if results is not None:
+            results.close()
+        if store is not None:
+            store.close()
+    if resumed:
+        print(f'Resumed after {resumed} rows', file=sys.stderr)
+    if sharded:
+        shards.mark_complete(out)
+    if args.excel or args.parquet:
+        with stage('export'):
+            writer.export(out / 'areas.csv',
+                          out / 'areas.xlsx' if args.excel else None,
+                          out / 'areas.parquet' if args.parquet else None)
+    if report is not None:
+        report.write(out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
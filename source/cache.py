@@ -0,0 +1,73 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+SCHEMA_VERSION = 2
+
+
+def result_key(header, version):
+    return f'{header.sop_uid}:{header.fingerprint}:{version}'
+
+
+def pack_mask(bin):
+    if bin.dtype != bool:
+        bin = bin != 0
+    return np.packbits(bin).tobytes(), bin.shape[0], bin.shape[1]
+
+
+def unpack_mask(packed, rows, cols):
+    bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=rows * cols)
+    return bits.view(bool).reshape(rows, cols)
+
+
+class ResultCache():
+    # areas (and optionally bit-packed masks) keyed by SOPInstanceUID, file
+    # fingerprint and algorithm version, so any change to either forces a recompute;
+    # multi-frame objects also keep their per-frame areas as a JSON list
+    def __init__(self, db_path, store_masks=False):
+        os.makedirs(Path(db_path).parent, exist_ok=True)
+        self.store_masks = store_masks
+        self.db = sqlite3.connect(str(db_path))
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS results')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'key TEXT PRIMARY KEY, area REAL, rows INTEGER, cols INTEGER, mask BLOB, frames TEXT)')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, with_mask=False):
+        row = self.db.execute('SELECT area, rows, cols, mask, frames FROM results WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None or (with_mask and row[3] is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        area, rows, cols, mask, frames = row
+        return area, ((mask, rows, cols) if with_mask else None), (json.loads(frames) if frames else None)
+
+    def put(self, key, area, packed=None, frames=None):
+        frames = json.dumps(frames) if frames is not None else None
+        if packed is not None and self.store_masks:
+            mask, rows, cols = packed
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, area, rows, cols, mask, frames))
+        else:
+            # never drop a mask already stored for this key
+            self.db.execute('INSERT OR IGNORE INTO results VALUES (?, ?, NULL, NULL, NULL, ?)', (key, area, frames))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
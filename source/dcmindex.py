@@ -0,0 +1,116 @@
+import hashlib
+import os
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+
+SCHEMA_VERSION = 3
+FINGERPRINT_CHUNK = 1 << 16
+# the only elements a scan needs; everything else is skipped while parsing
+TAGS = ['Modality', 'PatientID', 'AccessionNumber', 'SOPInstanceUID', 'NumberOfFrames', (0x0045, 0x101b),
+        (0x0018, 0x1164)]
+
+Header = namedtuple('Header', ['path', 'modality', 'patient_id', 'accession', 'projection',
+                               'spacing_x', 'spacing_y', 'sop_uid', 'fingerprint', 'frames'])
+
+
+def fingerprint(path):
+    # size plus the head and tail of the file: the tail holds the pixel data,
+    # so this changes whenever the image does without hashing the whole file
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        h.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+            h.update(f.read(FINGERPRINT_CHUNK))
+    return h.hexdigest()
+
+
+def header_from_dataset(path, dcm, fp=None):
+    proj = None
+    if (0x0045, 0x101b) in dcm:
+        proj = str(dcm[(0x0045, 0x101b)].value)[2:-1]
+    spacing = (None, None)
+    if (0x0018, 0x1164) in dcm:
+        spacing = tuple(float(v) for v in dcm[(0x0018, 0x1164)].value)
+    return Header(str(path), dcm.get('Modality'), dcm.get('PatientID'), dcm.get('AccessionNumber'),
+                  proj, spacing[0], spacing[1], dcm.get('SOPInstanceUID'), fp, int(dcm.get('NumberOfFrames') or 1))
+
+
+def unreadable(path):
+    return Header(str(path), *[None] * (len(Header._fields) - 1))
+
+
+def read_header(path):
+    import pydicom
+    try:
+        dcm = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=TAGS)
+    except Exception:
+        return unreadable(path)
+    fp = fingerprint(path) if dcm.get('Modality') == 'MG' else None
+    return header_from_dataset(path, dcm, fp)
+
+
+class HeaderIndex():
+    # rows are keyed by path and only trusted while size and mtime are unchanged;
+    # unreadable files are stored too (modality NULL) so they are not reopened
+    def __init__(self, db_path):
+        os.makedirs(Path(db_path).parent, exist_ok=True)
+        self.db = sqlite3.connect(str(db_path))
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS headers')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.db.execute('CREATE TABLE IF NOT EXISTS headers ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                        'modality TEXT, patient_id TEXT, accession TEXT, projection TEXT, '
+                        'spacing_x REAL, spacing_y REAL, sop_uid TEXT, fingerprint TEXT, frames INTEGER)')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        row = self.db.execute('SELECT modality, patient_id, accession, projection, spacing_x, spacing_y, sop_uid, '
+                              'fingerprint, frames '
+                              'FROM headers WHERE path = ? AND size = ? AND mtime = ?',
+                              (str(path), stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        return Header(str(path), *row)
+
+    def put(self, header, stat):
+        self.db.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (header.path, stat.st_size, stat.st_mtime_ns, *header[1:]))
+
+    def get_prefixed(self, prefix, stat):
+        # every row under prefix (e.g. the members of an archive) stored with this stat
+        rows = self.db.execute('SELECT path, modality, patient_id, accession, projection, spacing_x, spacing_y, '
+                               'sop_uid, fingerprint, frames '
+                               'FROM headers WHERE substr(path, 1, ?) = ? AND size = ? AND mtime = ?',
+                               (len(prefix), prefix, stat.st_size, stat.st_mtime_ns)).fetchall()
+        return [Header(*row) for row in rows]
+
+    def forget_prefixed(self, prefix):
+        self.db.execute('DELETE FROM headers WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+
+    def forget_missing(self, root, exists=os.path.exists):
+        root = str(Path(root))
+        stale = [p for (p,) in self.db.execute('SELECT path FROM headers WHERE substr(path, 1, ?) = ?',
+                                               (len(root), root))
+                 if not exists(p)]
+        self.db.executemany('DELETE FROM headers WHERE path = ?', [(p,) for p in stale])
+        return len(stale)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
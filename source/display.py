@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+
+MIN_LEVEL = 256
+
+
+def lut(dtype, lo, hi):
+    # uint8 value for every code of a <= 16 bit integer dtype, indexed by its unsigned view
+    bits = dtype.itemsize * 8
+    codes = np.arange(2 ** bits, dtype=np.int64)
+    if np.issubdtype(dtype, np.signedinteger):
+        codes[2 ** (bits - 1):] -= 2 ** bits
+    span = max(hi - lo, 1)
+    return (np.clip(codes - lo, 0, span) * 255 // span).astype(np.uint8)
+
+
+def apply_window(raw, lo, hi, table=None):
+    if np.issubdtype(raw.dtype, np.integer) and raw.dtype.itemsize <= 2:
+        if table is None:
+            table = lut(raw.dtype, lo, hi)
+        return table[raw.view(np.dtype(f'u{raw.dtype.itemsize}'))]
+    span = max(hi - lo, np.finfo(np.float64).eps)
+    return ((np.clip(raw, lo, hi) - lo) * (255 / span)).astype(np.uint8)
+
+
+def downsample(a):
+    # 2x2 box mean, keeping the dtype
+    h, w = a.shape[0] // 2 * 2, a.shape[1] // 2 * 2
+    acc = np.float64 if not np.issubdtype(a.dtype, np.integer) else np.int64
+    s = a[0:h:2, 0:w:2].astype(acc)
+    s += a[1:h:2, 0:w:2]
+    s += a[0:h:2, 1:w:2]
+    s += a[1:h:2, 1:w:2]
+    return (s // 4 if acc is np.int64 else s / 4).astype(a.dtype)
+
+
+class Pyramid():
+    # the raw image and its successive halvings, built once; a render picks the
+    # smallest level that still covers the requested size and maps it to 8 bit
+    # through a lookup table instead of a float normalisation
+    def __init__(self, raw, min_size=MIN_LEVEL):
+        self.levels = [raw]
+        while min(self.levels[-1].shape) >= 2 * min_size:
+            self.levels.append(downsample(self.levels[-1]))
+        self.lo = raw.min().item()
+        self.hi = raw.max().item()
+        self.table_key = None
+        self.table = None
+
+    def level_for(self, width=None, height=None):
+        if width is None or height is None:
+            return 0
+        rows, cols = self.levels[0].shape
+        scale = min(width / cols, height / rows)
+        if scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / scale))), len(self.levels) - 1)
+
+    def render(self, width=None, height=None, lo=None, hi=None):
+        lo = self.lo if lo is None else lo
+        hi = self.hi if hi is None else hi
+        level = self.levels[self.level_for(width, height)]
+        table = None
+        if np.issubdtype(level.dtype, np.integer) and level.dtype.itemsize <= 2:
+            if self.table_key != (lo, hi):
+                self.table_key = (lo, hi)
+                self.table = lut(level.dtype, lo, hi)
+            table = self.table
+        return apply_window(level, lo, hi, table)
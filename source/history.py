@@ -0,0 +1,87 @@
+from collections import deque
+
+import numpy as np
+
+TILE = 64
+MAX_BYTES = 64 << 20
+
+
+class Stroke():
+    def __init__(self):
+        self.tiles = []
+        self.delta = 0
+        self.nbytes = 0
+
+    def rect(self):
+        y0 = min(t[0] for t in self.tiles)
+        x0 = min(t[1] for t in self.tiles)
+        y1 = max(t[0] + t[2][0] for t in self.tiles)
+        x1 = max(t[1] + t[2][1] for t in self.tiles)
+        return y0, y1, x0, x1
+
+
+class MaskHistory():
+    # undo/redo for a binary (0/255) uint8 mask; a stroke keeps only the tiles it
+    # changed, bit-packed before and after, and the oldest strokes are dropped once
+    # the total exceeds max_bytes
+    def __init__(self, buffer, tile=TILE, max_bytes=MAX_BYTES):
+        self.buffer = buffer
+        self.tile = tile
+        self.max_bytes = max_bytes
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.nbytes = 0
+        self.before = {}
+
+    def touch(self, y0, y1, x0, x1):
+        # call before painting inside [y0:y1, x0:x1]
+        t = self.tile
+        for ty in range(y0 // t * t, y1, t):
+            for tx in range(x0 // t * t, x1, t):
+                if (ty, tx) not in self.before:
+                    self.before[(ty, tx)] = self.buffer[ty:ty + t, tx:tx + t] != 0
+
+    def commit(self):
+        if not self.before:
+            return
+        stroke = Stroke()
+        t = self.tile
+        for (ty, tx), before in self.before.items():
+            after = self.buffer[ty:ty + t, tx:tx + t] != 0
+            if np.array_equal(before, after):
+                continue
+            packed = (np.packbits(before), np.packbits(after))
+            stroke.tiles.append((ty, tx, before.shape, packed))
+            stroke.delta += int(np.count_nonzero(after)) - int(np.count_nonzero(before))
+            stroke.nbytes += packed[0].nbytes + packed[1].nbytes
+        self.before = {}
+        if not stroke.tiles:
+            return
+        self.undo_stack.append(stroke)
+        self.nbytes += stroke.nbytes
+        for s in self.redo_stack:
+            self.nbytes -= s.nbytes
+        self.redo_stack = []
+        while self.nbytes > self.max_bytes and len(self.undo_stack) > 1:
+            self.nbytes -= self.undo_stack.popleft().nbytes
+
+    def _apply(self, stroke, which):
+        for ty, tx, shape, packed in stroke.tiles:
+            bits = np.unpackbits(packed[which], count=shape[0] * shape[1]).reshape(shape)
+            self.buffer[ty:ty + shape[0], tx:tx + shape[1]] = bits * 255
+        return stroke.rect()
+
+    def undo(self):
+        # returns the changed (y0, y1, x0, x1) and the change in non-zero pixels
+        if not self.undo_stack:
+            return None
+        stroke = self.undo_stack.pop()
+        self.redo_stack.append(stroke)
+        return self._apply(stroke, 0), -stroke.delta
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        stroke = self.redo_stack.pop()
+        self.undo_stack.append(stroke)
+        return self._apply(stroke, 1), stroke.delta
@@ -1,18 +1,32 @@
-import pydicom
-import nibabel
-from skimage.filters import threshold_otsu
-from skimage.transform import resize
-from skimage import io
-from PIL import Image
-import pandas as pd
+import hashlib
 import sys
 import os
 from pathlib import Path
-import shutil
+import json
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import time
 from PyQt5.QtWidgets import QCheckBox, QLabel, QGridLayout, QPushButton, QWidget
-from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets, sip
 from PyQt5.QtCore import QSize, Qt
 import numpy as np
+import multiprocessing
+import batch
+import cache
+import dcmindex
+import display
+import history
+import maskstore
+import pixels
+import shards
+import threshold
+import timing
+import writer
+
+PREFETCH = 3
+# unfinished automatic-mode runs, by scanned root, so they can be resumed in place
+RUNS_PATH = batch.CACHE_DIR / 'gui_runs.json'
 
 try:
     from PyQt5.QtWinExtras import QtWin
@@ -29,22 +43,80 @@ def is_inside(point, rect):
 class Drawable():
     def __init__(self, array):
         self.dicom = array
-        self.raw_img = array.pixel_array
+        self.raw_img = pixels.decode(array)
         self.vox_dims = array[(0x0018, 0x1164)].value
         self.dims = list(self.raw_img.shape)
-
-    def get_drawable(self):
-        image = resize(self.raw_img, self.dims, anti_aliasing=True)
-        image = ((image - image.min())/(image.max() - image.min())*255).astype(np.uint8)
-        drawable = QtGui.QImage(image.tobytes('C'), self.dims[1], self.dims[0], self.dims[1], QtGui.QImage.Format_Grayscale8)
+        self.window = None
+        self.pyramid = None
+
+    def get_pyramid(self):
+        if self.pyramid is None:
+            self.pyramid = display.Pyramid(self.raw_img)
+        return self.pyramid
+
+    def get_window(self):
+        pyramid = self.get_pyramid()
+        return self.window or (pyramid.lo, pyramid.hi)
+
+    def get_drawable(self, size=None):
+        # full resolution by default, otherwise the closest pyramid level covering `size`
+        lo, hi = self.get_window()
+        if size is None:
+            image = self.get_pyramid().render(lo=lo, hi=hi)
+        else:
+            image = self.get_pyramid().render(size.width(), size.height(), lo, hi)
+        rows, cols = image.shape
+        drawable = QtGui.QImage(image.tobytes('C'), cols, rows, cols, QtGui.QImage.Format_Grayscale8)
         return drawable
 
 class Mask(Drawable):
     def __init__(self, array):
         super().__init__(array)
-        thresh = threshold_otsu(array.pixel_array)
-        bin = (array.pixel_array > thresh) * 255
-        self.raw_img = bin
+        self.raw_img = threshold.mask(self.raw_img)
+
+Prepared = namedtuple('Prepared', ['dataset', 'drawable', 'mask'])
+
+def prepare(path):
+    # everything an image needs before it is shown; safe off the GUI thread
+    # because it only decodes pixels and builds the display pyramid, never
+    # pixmaps or widgets
+    img = pixels.open_dataset(path)
+    try:
+        if img.Modality != 'MG':
+            raise TypeError('')
+    except:
+        raise TypeError('')
+    drawable = Drawable(img)
+    drawable.get_pyramid()
+    return Prepared(img, drawable, Mask(img))
+
+class ReviewQueue():
+    # decodes the next `ahead` images (and the previous one) in the background
+    # and forgets anything outside that window so memory stays bounded
+    def __init__(self, paths, ahead=PREFETCH):
+        self.paths = list(paths)
+        self.ahead = ahead
+        self.pos = 0
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.futures = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def move_to(self, i):
+        self.pos = i
+        window = range(max(i - 1, 0), min(i + self.ahead + 1, len(self.paths)))
+        for j in list(self.futures):
+            if j not in window:
+                self.futures.pop(j).cancel()
+        for j in [i] + [j for j in window if j != i]:
+            if j not in self.futures:
+                self.futures[j] = self.pool.submit(prepare, self.paths[j])
+        return self.futures[i].result()
+
+    def close(self):
+        self.futures = {}
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
 class MouseCircle(QLabel):
     def __init__(self, parent):
@@ -82,7 +154,14 @@ class MaskFrame(QtWidgets.QLabel):
         self.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
         self.setFrameShape(QtWidgets.QFrame.Box)
         self.dcm = None
-        self.draw_point = None
+        self.image = None
+        self.buffer = None
+        self.count = 0
+        self.history = None
+        self.view = None
+        self.view_origin = QtCore.QPoint(0, 0)
+        self.pending = []
+        self.flush_scheduled = False
         
         self.installEventFilter(self)
         self.brush_radius = 30
@@ -93,31 +172,101 @@ class MaskFrame(QtWidgets.QLabel):
         
         self.m_circle = MouseCircle(self)
 
-    def setImage(self, img):
-        self.dcm = Mask(img)
-        self.pix = QtGui.QPixmap(self.dcm.get_drawable())
-        self.setPixmap(self.pix)
+    def setImage(self, img, prepared=None, edited=None):
+        # `edited` is a mask packed by cache.pack_mask that replaces the
+        # thresholded one, e.g. the reviewer's edits to an image visited before
+        self.dcm = prepared.mask if prepared is not None else Mask(img)
+        h, w = self.dcm.dims
+        # the QImage paints straight into this numpy buffer, so the mask never
+        # has to be copied out of Qt to be measured or saved
+        self.buffer = np.zeros((h, w), dtype=np.uint8)
+        self.buffer[self.dcm.raw_img if edited is None else cache.unpack_mask(*edited)] = 255
+        self.image = QtGui.QImage(sip.voidptr(self.buffer.ctypes.data), w, h, w, QtGui.QImage.Format_Grayscale8)
+        self.count = int(np.count_nonzero(self.buffer))
+        self.history = history.MaskHistory(self.buffer)
+        self.view = None
+        self.update()
+
+    def layout_view(self):
+        # the scaled view is built once per widget size; strokes only patch it
+        size = self.size()
+        view_size = self.image.size().scaled(size, Qt.KeepAspectRatio)
+        self.view = QtGui.QPixmap.fromImage(self.image.scaled(view_size, Qt.IgnoreAspectRatio, transformMode = Qt.FastTransformation))
+        self.scale = self.image.width() / self.view.width()
+        self.view_origin = QtCore.QPoint(int((size.width() - self.view.width())/2), int((size.height() - self.view.height())/2))
+        point = self.view_origin
+        self.img_rect = [point.x(), point.y(), point.x() + self.view.width(), point.y() + self.view.height()]
+
+    def refresh_view(self, rect):
+        sx = self.image.width() / self.view.width()
+        sy = self.image.height() / self.view.height()
+        x0 = max(int(rect.left() / sx) - 1, 0)
+        y0 = max(int(rect.top() / sy) - 1, 0)
+        x1 = min(int((rect.right() + 1) / sx) + 2, self.view.width())
+        y1 = min(int((rect.bottom() + 1) / sy) + 2, self.view.height())
+        target = QtCore.QRect(x0, y0, x1 - x0, y1 - y0)
+        source = QtCore.QRectF(x0 * sx, y0 * sy, (x1 - x0) * sx, (y1 - y0) * sy)
+        painter = QtGui.QPainter(self.view)
+        painter.drawImage(QtCore.QRectF(target), self.image, source)
+        painter.end()
+        return target
+
+    def resizeEvent(self, event):
+        self.view = None
+        super().resizeEvent(event)
 
     def paintEvent(self, event):
-        if not self.pix.isNull():
-            size = self.size()
-            scaledPix = self.pix.scaled(size, Qt.KeepAspectRatio, transformMode = Qt.FastTransformation)
-            self.scale = self.pix.width() / scaledPix.width()
-            point = QtCore.QPoint(0,0)
-            point.setX(int((size.width() - scaledPix.width())/2))
-            point.setY(int((size.height() - scaledPix.height())/2))
-            
-            self.img_rect = [point.x(), point.y(), point.x() + scaledPix.width(), point.y() + scaledPix.height()]
-            if self.draw_point:
-                if is_inside((self.draw_point.x(), self.draw_point.y()), self.img_rect):
-                    painter = QtGui.QPainter(self.pix)
-                    painter.setPen(Qt.NoPen)
-                    painter.setBrush(QtGui.QBrush(self.brush_color, Qt.SolidPattern))
-                    painter.drawEllipse((self.draw_point - point)* self.scale, self.brush_radius * self.scale, self.brush_radius * self.scale)
-                    self.draw_point = None
-            scaledPix = self.pix.scaled(size, Qt.KeepAspectRatio, transformMode = Qt.FastTransformation)
+        if self.image is not None:
+            if self.view is None:
+                self.layout_view()
             label_painter = QtGui.QPainter(self)
-            label_painter.drawPixmap(point, scaledPix)
+            label_painter.setClipRect(event.rect())
+            label_painter.drawPixmap(self.view_origin, self.view)
+
+    def queue_dab(self, pos):
+        # mouse samples are collected and painted together once the event
+        # queue is drained, so a burst of moves costs one repaint
+        self.pending.append(QtCore.QPoint(pos))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            QtCore.QTimer.singleShot(0, self.flush_dabs)
+
+    def flush_dabs(self):
+        self.flush_scheduled = False
+        pending, self.pending = self.pending, []
+        if self.image is None or not pending:
+            return
+        if self.view is None:
+            self.layout_view()
+        points = [p - self.view_origin for p in pending if is_inside((p.x(), p.y()), self.img_rect)]
+        dirty = self.draw(points)
+        if dirty is not None:
+            self.update(self.refresh_view(dirty).translated(self.view_origin))
+
+    def draw(self, points):
+        # only the pixels under the brush can change, so the area is updated
+        # from the difference inside the bounding box of the dabs
+        r = self.brush_radius * self.scale
+        h, w = self.buffer.shape
+        centers = [(p.x() * self.scale, p.y() * self.scale) for p in points]
+        if not centers:
+            return None
+        x0 = max(int(min(c[0] for c in centers) - r) - 1, 0)
+        x1 = min(int(max(c[0] for c in centers) + r) + 2, w)
+        y0 = max(int(min(c[1] for c in centers) - r) - 1, 0)
+        y1 = min(int(max(c[1] for c in centers) + r) + 2, h)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        self.history.touch(y0, y1, x0, x1)
+        before = np.count_nonzero(self.buffer[y0:y1, x0:x1])
+        painter = QtGui.QPainter(self.image)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QtGui.QBrush(self.brush_color, Qt.SolidPattern))
+        for cx, cy in centers:
+            painter.drawEllipse(QtCore.QPointF(cx, cy), r, r)
+        painter.end()
+        self.count += int(np.count_nonzero(self.buffer[y0:y1, x0:x1])) - before
+        return QtCore.QRect(x0, y0, x1 - x0, y1 - y0)
 
     def set_brush_radius(self, rad):
         self.brush_radius = rad
@@ -128,8 +277,7 @@ class MaskFrame(QtWidgets.QLabel):
 
     def mouseMoveEvent(self, event):
         if self.is_drawing is True:
-            self.draw_point = event.pos()
-        self.repaint()
+            self.queue_dab(event.pos())
         self.m_circle.move(event.pos() - QtCore.QPoint(self.m_circle.rad, self.m_circle.rad))
         mouse_point = event.pos()
         if self.img_rect:
@@ -142,39 +290,53 @@ class MaskFrame(QtWidgets.QLabel):
             self.m_circle.hide()
 
     def mousePressEvent(self, event):
-        self.draw_point = event.pos()
-        self.repaint()
+        self.queue_dab(event.pos())
         self.is_drawing = True
 
     def mouseReleaseEvent(self, event):
         self.is_drawing = False
-        self.area_label_hook.setText(f'Segmented area: {self.get_image_area()} \u339F')
+        self.flush_dabs()
+        if self.history is not None:
+            self.history.commit()
+        self.update_area_label()
+
+    def update_area_label(self):
+        if self.area_label_hook is not None:
+            self.area_label_hook.setText(f'Segmented area: {self.get_image_area()} \u339F')
+
+    def is_edited(self):
+        return self.history is not None and bool(self.history.undo_stack)
+
+    def undo(self):
+        self.restore(self.history.undo() if self.history is not None else None)
+
+    def redo(self):
+        self.restore(self.history.redo() if self.history is not None else None)
+
+    def restore(self, change):
+        if change is None:
+            return
+        (y0, y1, x0, x1), delta = change
+        self.count += delta
+        if self.view is not None:
+            self.update(self.refresh_view(QtCore.QRect(x0, y0, x1 - x0, y1 - y0)).translated(self.view_origin))
+        self.update_area_label()
 
     def get_image_area(self):
-        image = self.pix.toImage().convertToFormat(QtGui.QImage.Format_Grayscale8)
-        fn = os.path.expanduser('~') + f'/.MammArea/tmp_msk_{np.random.rand(1)}.png'
-        image.save(fn)
-        np_img = io.imread(fn)
-        np_img[np_img != 0] = 255
-        area = np.sum(np_img == 255) * self.dcm.vox_dims[0] * self.dcm.vox_dims[1]
-        os.remove(fn)
+        area = self.count * self.dcm.vox_dims[0] * self.dcm.vox_dims[1]
         return np.round(area, 2)
 
     def save_image(self):
-        image = self.pix.toImage().convertToFormat(QtGui.QImage.Format_Grayscale8)
-        fn = os.path.expanduser('~') + f'/.MammArea/tmp_msk_{np.random.rand(1)}.png'
-        image.save(fn)
-        np_img = io.imread(fn)
-        np_img[np_img != 0] = 255
-        area = np.sum(np_img == 255) * self.dcm.vox_dims[0] * self.dcm.vox_dims[1]
-        os.remove(fn)
+        # nibabel is only needed here, so it is not imported at start up
+        import nibabel
+        area = self.get_image_area()
         x, y = self.dcm.vox_dims
         affine = np.array([[x, 0, 0, 0],
                            [0, y, 0, 0],
                            [0, 0, 1, 0],
                            [0, 0, 0, 1]])
 
-        mask = nibabel.Nifti1Image(np_img.T, affine=affine)
+        mask = nibabel.Nifti1Image(self.buffer.T, affine=affine)
         mask.set_sform(None, code=0)
         mask.set_qform(None, code=0)
         filepath = QtWidgets.QFileDialog.getSaveFileName(None, 'Save mask', 
@@ -188,7 +350,8 @@ class MaskFrame(QtWidgets.QLabel):
                 nibabel.save(mask, savepath)
             else:
                 try:
-                    image.save(str(savepath))
+                    if not self.image.save(str(savepath)):
+                        raise ValueError(savepath.suffix)
                 except:
                     err = QtWidgets.QMessageBox()
                     err.about(self, 'Error', 'Extension not supported!')
@@ -200,23 +363,56 @@ class ImageFrame(QtWidgets.QLabel):
         self.setFrameShape(QtWidgets.QFrame.Box)
         self.setMouseTracking(True)
         self.dcm = None
+        self.view = None
+        self.leveling = None
 
         self.installEventFilter(self)
 
-    def setImage(self, img):
-        self.dcm = Drawable(img)
-        self.pix = QtGui.QPixmap(self.dcm.get_drawable())
-        self.setPixmap(self.pix)
+    def setImage(self, img, prepared=None):
+        self.dcm = prepared.drawable if prepared is not None else Drawable(img)
+        self.view = None
+        self.update()
+
+    def mousePressEvent(self, event):
+        # right drag: horizontal sets the window width, vertical the level
+        if event.button() == Qt.RightButton and self.dcm is not None:
+            self.leveling = (event.pos(), self.dcm.get_window())
+
+    def mouseMoveEvent(self, event):
+        if self.leveling is not None and event.buttons() & Qt.RightButton:
+            start, (lo, hi) = self.leveling
+            pyramid = self.dcm.get_pyramid()
+            span = pyramid.hi - pyramid.lo
+            width = max(1, (hi - lo) + (event.x() - start.x()) * span / max(self.width(), 1))
+            center = (hi + lo) / 2 + (event.y() - start.y()) * span / max(self.height(), 1)
+            self.dcm.window = (int(center - width / 2), int(center + width / 2))
+            self.view = None
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.RightButton:
+            self.leveling = None
+
+    def mouseDoubleClickEvent(self, event):
+        if self.dcm is not None:
+            self.dcm.window = None
+            self.view = None
+            self.update()
+
+    def resizeEvent(self, event):
+        self.view = None
+        super().resizeEvent(event)
 
     def paintEvent(self, event):
-        if not self.pix.isNull():
-            size = self.size()
-            scaledPix = self.pix.scaled(size, Qt.KeepAspectRatio, transformMode = Qt.FastTransformation)
-            point = QtCore.QPoint(0,0)
-            point.setX(int((size.width() - scaledPix.width())/2))
-            point.setY(int((size.height() - scaledPix.height())/2))
+        if self.dcm is not None:
+            if self.view is None:
+                size = self.size()
+                image = self.dcm.get_drawable(size)
+                self.view = QtGui.QPixmap.fromImage(image).scaled(size, Qt.KeepAspectRatio, transformMode = Qt.FastTransformation)
+                self.view_origin = QtCore.QPoint(int((size.width() - self.view.width())/2), int((size.height() - self.view.height())/2))
             label_painter = QtGui.QPainter(self)
-            label_painter.drawPixmap(point, scaledPix)
+            label_painter.setClipRect(event.rect())
+            label_painter.drawPixmap(self.view_origin, self.view)
 
 class ManualWindow(QtWidgets.QWidget):
     def __init__(self, parent):
@@ -235,16 +431,13 @@ class ManualWindow(QtWidgets.QWidget):
         self.layout.addWidget(self.mmask,1,1)
         self.setLayout(self.layout)
 
-    def createGridLayout(self, path):
-        img = pydicom.dcmread(path)
-        try:
-            if img.Modality != 'MG':
-                raise TypeError('')
-        except:
-            raise TypeError('')
+    def createGridLayout(self, path, prepared=None, edited=None):
+        if prepared is None:
+            prepared = prepare(path)
+        img = prepared.dataset
 
-        self.mmask.setImage(img)
-        self.mimage.setImage(img)
+        self.mmask.setImage(img, prepared, edited)
+        self.mimage.setImage(img, prepared)
         proj = None
         try:
             proj = str(img[(0x0045, 0x101b)].value)[2:-1]
@@ -253,7 +446,8 @@ class ManualWindow(QtWidgets.QWidget):
             err.about(self, 'Warning', 'It seems not a 2D projection!')
             proj = None
         screen = self.parent_window.available_size
-        self.parent_window.setGeometry(screen.adjusted(int(screen.size().height()*0.1), int(screen.size().height()*0.1), int(-screen.size().width()*0.1), int(-screen.size().width()*0.1)))
+        if self.parent_window.central != 'manual':
+            self.parent_window.setGeometry(screen.adjusted(int(screen.size().height()*0.1), int(screen.size().height()*0.1), int(-screen.size().width()*0.1), int(-screen.size().width()*0.1)))
         self.idpacs_label.setText(f"ID PACS: {img.PatientID}\nAccession Number: {img.AccessionNumber}\nProjection: {proj}")
         self.area_label.setText(f'Segmented area: {self.mmask.get_image_area()} \u339F')
         self.mmask.area_label_hook = self.area_label
@@ -279,108 +473,285 @@ class InitWindow(QtWidgets.QWidget):
         self.layout.addWidget(self.manual, 0,0)
         self.layout.addWidget(self.auto, 0,1)
 
+class BatchWorker(QtCore.QThread):
+    # runs job(progress, cancel) off the GUI thread; the outcome is read back
+    # from result / cancelled / error once the finished signal fires
+    progressed = QtCore.pyqtSignal(int, int)
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        self.cancel_event = threading.Event()
+        self.result = None
+        self.cancelled = False
+        self.abandoned = False
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.job(self.progressed.emit, self.cancel_event)
+        except batch.Cancelled:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancel_event.set()
+
 class AutoWindow(QtWidgets.QWidget):
     def __init__(self, parent):
         super().__init__()
         self.parent_win = parent
+        self.worker = None
+        self.running = set()
+        self.mg_headers = []
         self.layout = QGridLayout()
         self.info = QLabel('Reading folders...')
         self.progress = QtWidgets.QProgressBar()
         self.progress.setRange(0, 100)
         self.progress.setAlignment(Qt.AlignCenter)
         self.progress.setFixedSize(QtCore.QSize(250, 30))
+        self.rate = QLabel()
         self.mask_box = QCheckBox('Save masks')
+        self.store_box = QCheckBox('As one HDF5 file')
+        self.store_box.setEnabled(maskstore.available())
+        self.report_box = QCheckBox('Timing report')
+        # this workstation's part of a cohort split across several machines
+        self.shard_index = QtWidgets.QSpinBox()
+        self.shard_index.setRange(0, 0)
+        self.shard_count = QtWidgets.QSpinBox()
+        self.shard_count.setRange(1, 999)
+        self.shard_count.valueChanged.connect(lambda n: self.shard_index.setMaximum(n - 1))
+        self.scan_seconds = None
         self.start_button = QPushButton('Start calculation')
         self.start_button.clicked.connect(lambda x: self.calc())
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(lambda x: self.cancel())
+        self.cancel_button.setDisabled(True)
+        self.review_button = QPushButton('Review masks')
+        self.review_button.clicked.connect(lambda x: self.parent_win.set_review([h.path for h in self.mg_headers]))
+        self.review_button.setDisabled(True)
         self.layout.addWidget(self.info, 0, 0, 1, 1)
         self.layout.addWidget(self.mask_box, 1, 0, Qt.AlignRight)
         self.layout.addWidget(self.start_button, 1, 1, Qt.AlignLeft)
-        self.layout.addWidget(self.progress, 2, 0, 1, 2, Qt.AlignCenter)
+        self.layout.addWidget(self.store_box, 2, 0, Qt.AlignRight)
+        self.layout.addWidget(self.report_box, 2, 1, Qt.AlignLeft)
+        self.layout.addWidget(self.progress, 3, 0, 1, 2, Qt.AlignCenter)
+        self.layout.addWidget(self.rate, 4, 0, Qt.AlignRight)
+        self.layout.addWidget(self.cancel_button, 4, 1, Qt.AlignLeft)
+        self.layout.addWidget(self.review_button, 0, 1, Qt.AlignLeft)
+        shard = QtWidgets.QHBoxLayout()
+        shard.addWidget(QLabel('Shard'))
+        shard.addWidget(self.shard_index)
+        shard.addWidget(QLabel('of'))
+        shard.addWidget(self.shard_count)
+        self.layout.addLayout(shard, 5, 0, 1, 2, Qt.AlignCenter)
         self.setLayout(self.layout)
 
-    def calc(self):
-        df = {'IDPACS':[], 'Accession Number':[], 'Projection':[], 'Area':[]}
-        self.start_button.setDisabled(True)
-        self.info.setText('Calculation ongoing...')
+    def start_worker(self, job, done):
+        worker = BatchWorker(job)
+        self.worker = worker
+        self.rate_start = None
+        worker.progressed.connect(self.show_progress)
+        worker.finished.connect(lambda: self.worker_finished(worker, done))
+        self.running.add(worker)
         self.progress.setValue(0)
-        save = self.mask_box.isChecked()
-        fn = Path(os.path.expanduser('~') + f'/.MammArea/save_{np.random.rand(1)}')
-        os.makedirs(fn, exist_ok=True)
-        l = len(self.mg_paths)
-        for i, p in enumerate(self.mg_paths):
-            dcm = pydicom.dcmread(p)
-            idpacs = dcm.PatientID
-            acc = dcm.AccessionNumber
-            proj = str(dcm[(0x0045, 0x101b)].value)[2:-1]
-
-            thresh = threshold_otsu(dcm.pixel_array)
-            bin = (dcm.pixel_array > thresh) * 255
-            vox_dims = dcm[(0x0018, 0x1164)].value
-            area = np.sum(bin == 255) * vox_dims[0] * vox_dims[1]
-            if save:
-                os.makedirs(fn / idpacs / acc, exist_ok=True)
-                Image.fromarray(bin.astype(np.uint8)).save(fn / idpacs / acc / f'{proj}_{int(area)}mm2.png')
-                x, y = vox_dims
-                affine = np.array([[x, 0, 0, 0],
-                                [0, y, 0, 0],
-                                [0, 0, 1, 0],
-                                [0, 0, 0, 1]])
-
-                mask = nibabel.Nifti1Image(bin.T, affine=affine)
-                mask.set_sform(None, code=0)
-                mask.set_qform(None, code=0)
-                nibabel.save(mask, fn / idpacs / acc / f'{proj}_{int(area)}mm2.nii.gz')
-            df['IDPACS'].append(idpacs)
-            df['Accession Number'].append(acc)
-            df['Projection'].append(proj)
-            df['Area'].append(np.round(area,2))
-            self.progress.setValue(int(i/l*100))
-        
-        self.progress.setValue(100)
-        pd.DataFrame(df).to_excel(fn / 'areas.xlsx')
+        self.rate.setText('')
+        self.start_button.setDisabled(True)
+        self.review_button.setDisabled(True)
+        self.cancel_button.setDisabled(False)
+        worker.start()
+
+    def worker_finished(self, worker, done):
+        # superseded workers (e.g. a scan cancelled by Exit) are only released
+        self.running.discard(worker)
+        if worker is self.worker:
+            if worker.abandoned:
+                # left with Exit: no dialogs; a calculation stays checkpointed for a resume
+                self.finish_worker()
+            else:
+                done(worker)
+
+    def show_progress(self, i, l):
+        self.last_progress = (i, l)
+        self.progress.setValue(int(i/l*100) if l else 100)
+        now = time.monotonic()
+        if self.rate_start is None:
+            self.rate_start = (now, i)
+            return
+        t0, i0 = self.rate_start
+        if now > t0 and i > i0:
+            speed = (i - i0) / (now - t0)
+            eta = int((l - i) / speed)
+            self.rate.setText(f'{speed:.1f} images/s, ETA {eta // 60}:{eta % 60:02d}')
+
+    def cancel(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
+            self.cancel_button.setDisabled(True)
+            self.info.setText('Cancelling...')
+
+    def abandon(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.abandoned = True
+        self.cancel()
+
+    def finish_worker(self):
+        self.worker = None
+        self.cancel_button.setDisabled(True)
+        self.start_button.setDisabled(False)
+        self.review_button.setDisabled(len(self.mg_headers) == 0)
 
+    def load_runs(self):
+        try:
+            with open(RUNS_PATH) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_runs(self, runs):
+        os.makedirs(RUNS_PATH.parent, exist_ok=True)
+        with open(RUNS_PATH, 'w') as f:
+            json.dump(runs, f, indent=2)
+
+    def run_key(self, shard):
+        return f'{Path(self.proot).resolve()}:{shard}'
+
+    def run_folder(self, shard):
+        # results, masks and the HDF5 store are written straight into the
+        # destination folder; an unfinished run of the same root (and shard)
+        # reuses its folder and resumes from the checkpoint there
+        key = self.run_key(shard)
+        runs = self.load_runs()
+        if key in runs and Path(runs[key]).is_dir():
+            return Path(runs[key])
         filepath = QtWidgets.QFileDialog.getExistingDirectory(None,
                                                     'Select results data folder',
                                                     self.parent_win.preferred_folder,
                                                     QtWidgets.QFileDialog.ShowDirsOnly)
-        if filepath:
-            self.parent_win.preferred_folder = filepath
-            dest = Path(filepath) / f'results_{int(np.random.rand(1)*10000)}'
+        if not filepath:
+            return None
+        self.parent_win.preferred_folder = filepath
+        if shard is not None:
+            fn = Path(filepath) / shards.folder_name(*shard)
+        else:
+            digest = hashlib.blake2b(key.encode(), digest_size=4).hexdigest()
+            fn = Path(filepath) / f'results_{Path(self.proot).name}_{digest}'
+        runs[key] = str(fn)
+        self.save_runs(runs)
+        return fn
+
+    def forget_run(self, shard):
+        runs = self.load_runs()
+        if runs.pop(self.run_key(shard), None) is not None:
+            self.save_runs(runs)
+
+    def calc(self):
+        save = self.mask_box.isChecked()
+        single = save and self.store_box.isChecked()
+        index, count = self.shard_index.value(), self.shard_count.value()
+        shard = (index, count) if count > 1 else None
+        fn = self.run_folder(shard)
+        if fn is None:
+            return
+        try:
+            os.makedirs(fn, exist_ok=True)
+        except OSError as e:
+            print(e)
+            self.forget_run(shard)
+            err = QtWidgets.QMessageBox()
+            err.about(self, 'Error', "Couldn't write here!")
+            return
+        self.info.setText('Calculation ongoing...')
+        self.last_progress = (0, 0)
+        headers = self.mg_headers if shard is None else shards.select(self.mg_headers, index, count)
+        if shard is not None:
+            shards.write_manifest(fn, self.mg_headers, headers, index, count)
+        report = timing.RunReport() if self.report_box.isChecked() else None
+        stage = report.stage if report is not None else timing.NULL.stage
+        if report is not None and self.scan_seconds is not None:
+            report.add_total('scan', self.scan_seconds, len(headers))
+        # tomosynthesis objects also get their per-frame areas
+        frames = fn / 'frames.csv' if any((h.frames or 1) > 1 for h in headers) else None
+
+        def job(progress, cancel):
+            store = maskstore.MaskStore(fn / 'masks.h5') if single else None
             try:
-                shutil.move(fn, dest)
-                self.info.setText('Data saved correctly!')
-            except Exception as e:
-                print(e)
-                err = QtWidgets.QMessageBox()
-                err.about(self, 'Error', "Couldn't write here!")
-                self.info.setText('Retry...')
-        
-        self.start_button.setDisabled(False)
-        
+                with cache.ResultCache(batch.RESULTS_PATH, store_masks=save) as results:
+                    with stage('calc', len(headers)):
+                        batch.run_to_csv(headers, fn / 'areas.csv', fn if save and not single else None, results=results,
+                                         progress=progress, cancel=cancel, store=store, report=report,
+                                         frames_path=frames)
+            finally:
+                if store is not None:
+                    store.close()
+
+        self.start_worker(job, lambda worker: self.calc_done(worker, fn, report, shard, len(headers)))
+
+    def calc_done(self, worker, fn, report=None, shard=None, total=None):
+        self.finish_worker()
+        if worker.error is not None:
+            print(worker.error)
+            err = QtWidgets.QMessageBox()
+            err.about(self, 'Error', f'Calculation failed: {worker.error}')
+            self.info.setText('Retry...')
+            return
+        if worker.cancelled:
+            # the rows done so far stay checkpointed in the run folder
+            self.info.setText(f'Cancelled after {self.last_progress[0]} of {total or len(self.mg_headers)} images,\n'
+                              'start again to resume')
+            return
+        self.progress.setValue(100)
+        if shard is not None:
+            shards.mark_complete(fn)
+        t0 = time.perf_counter()
+        saved = 'Data saved correctly!'
+        try:
+            writer.export(fn / 'areas.csv', excel=fn / 'areas.xlsx')
+        except ValueError as e:
+            print(e)
+            saved = 'Too many rows for Excel, data saved as CSV'
+        if report is not None:
+            report.add_total('export', time.perf_counter() - t0)
+            report.write(fn)
+        self.forget_run(shard)
+        self.info.setText(saved)
 
     def createGridLayout(self, path):
         self.parent_win.setGeometry(QtCore.QRect(QtCore.QPoint(int(self.parent_win.available_size.width()/2), int(self.parent_win.available_size.height()/2)), QSize(300, 300)))
         self.proot = path
-        
-        self.mg_paths = []
-        id = []
-        acc = []
-        path_list = list(Path(path).rglob('*.dcm'))
-        l = len(path_list)
-        for i, p in enumerate(path_list):
-            self.progress.setValue(int((i+1)/l*100))
-            try:
-                dcm = pydicom.dcmread(p, stop_before_pixels=True)
-                if dcm.Modality == 'MG':
-                    id.append(dcm.PatientID)
-                    acc.append(dcm.AccessionNumber)
-                    self.mg_paths.append(p)
-            except:
-                pass
+        self.mg_headers = []
+        self.review_button.setDisabled(True)
+        self.info.setText('Reading folders...')
+
+        def job(progress, cancel):
+            t0 = time.perf_counter()
+            with dcmindex.HeaderIndex(batch.INDEX_PATH) as index:
+                headers = batch.scan(path, index, progress, cancel)
+            self.scan_seconds = time.perf_counter() - t0
+            return headers
+
+        self.start_worker(job, self.scan_done)
+
+    def scan_done(self, worker):
+        self.finish_worker()
+        if worker.cancelled:
+            self.parent_win.set_init()
+            return
+        if worker.error is not None:
+            print(worker.error)
+            err = QtWidgets.QMessageBox()
+            err.about(self, 'Error', f"Couldn't read the folder: {worker.error}")
+            self.parent_win.set_init()
+            return
+        self.mg_headers = worker.result
+        self.review_button.setDisabled(len(self.mg_headers) == 0)
+        id = [h.patient_id for h in self.mg_headers]
+        acc = [h.accession for h in self.mg_headers]
 
         self.progress.setValue(100)
-        self.info.setText(f'Read \t{len(self.mg_paths)} images\n\t{len(np.unique(id))} IDs\n\t{len(np.unique(acc))} Accession Numbers')
-        if len(self.mg_paths) == 0:
+        self.info.setText(f'Read \t{len(self.mg_headers)} images\n\t{len(np.unique(id))} IDs\n\t{len(np.unique(acc))} Accession Numbers')
+        if len(self.mg_headers) == 0:
             err = QtWidgets.QMessageBox()
             err.about(self, 'Error', "No MG Dicom files found!")
             self.parent_win.set_automatic()
@@ -394,6 +765,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setMouseTracking(True)
 
         self.preferred_folder = os.path.expanduser('~')
+        self.review = None
+        self.review_edits = {}
         self.stack = QtWidgets.QStackedLayout()
         self.manual_window = ManualWindow(self)
         self.auto_window = AutoWindow(self)
@@ -430,6 +803,51 @@ class MainWindow(QtWidgets.QMainWindow):
             err = QtWidgets.QMessageBox()
             err.about(self, 'Error', "File path doesn't exist!")
 
+    def set_review(self, paths):
+        if self.review is not None:
+            self.review.close()
+        self.review = ReviewQueue(paths)
+        self.review_edits = {}
+        try:
+            self.removeToolBar(self.editToolbar)
+        except:
+            pass
+        self.create_manual_toolbar()
+        self.create_review_actions()
+        self.review_step(0)
+
+    def review_step(self, delta):
+        if self.review is None:
+            return
+        if delta and self.manual_window.mmask.is_edited():
+            # brush edits are kept bit-packed per image, so stepping away and
+            # back shows the mask as the reviewer left it
+            self.review_edits[self.review.pos] = cache.pack_mask(self.manual_window.mmask.buffer)
+        i = self.review.pos + delta
+        while 0 <= i < len(self.review):
+            try:
+                prepared = self.review.move_to(i)
+            except Exception as e:
+                # unreadable or non-MG files are skipped in the direction of travel
+                print(f'{self.review.paths[i]}: {e!r}')
+                i += 1 if delta >= 0 else -1
+                continue
+            self.manual_window.createGridLayout(self.review.paths[i], prepared, self.review_edits.get(i))
+            self.stack.setCurrentIndex(1)
+            self.central = 'manual'
+            self.setWindowTitle(f'{self.title} - {i + 1}/{len(self.review)}')
+            return
+
+    def create_review_actions(self):
+        prevAction = QtWidgets.QAction(self.style().standardIcon(QtWidgets.QStyle.SP_MediaSkipBackward), 'Previous', self)
+        prevAction.setShortcuts([QtGui.QKeySequence(Qt.Key_Left), QtGui.QKeySequence(Qt.Key_PageUp)])
+        self.editToolbar.addAction(prevAction)
+        prevAction.triggered.connect(lambda x: self.review_step(-1))
+        nextAction = QtWidgets.QAction(self.style().standardIcon(QtWidgets.QStyle.SP_MediaSkipForward), 'Next', self)
+        nextAction.setShortcuts([QtGui.QKeySequence(Qt.Key_Right), QtGui.QKeySequence(Qt.Key_PageDown)])
+        self.editToolbar.addAction(nextAction)
+        nextAction.triggered.connect(lambda x: self.review_step(1))
+
     def set_automatic(self):
         filepath = QtWidgets.QFileDialog.getExistingDirectory(None,
                                                                    'Select root folder',
@@ -445,6 +863,12 @@ class MainWindow(QtWidgets.QMainWindow):
             self.set_init()
 
     def set_init(self):
+        self.auto_window.abandon()
+        if self.review is not None:
+            self.review.close()
+            self.review = None
+            self.review_edits = {}
+        self.setWindowTitle(self.title)
         self.setGeometry(QtCore.QRect(QtCore.QPoint(int(self.available_size.width()/2), int(self.available_size.height()/2)), QSize(300, 300)))
         self.stack.setCurrentIndex(0)
         try:
@@ -486,6 +910,15 @@ class MainWindow(QtWidgets.QMainWindow):
         sizeContainer.setLayout(vbox)
         self.editToolbar.addWidget(sizeContainer)
 
+        undoAction = QtWidgets.QAction(self.style().standardIcon(QtWidgets.QStyle.SP_ArrowBack), 'Undo', self)
+        undoAction.setShortcut(QtGui.QKeySequence.Undo)
+        self.editToolbar.addAction(undoAction)
+        undoAction.triggered.connect(lambda x: self.manual_window.mmask.undo())
+        redoAction = QtWidgets.QAction(self.style().standardIcon(QtWidgets.QStyle.SP_ArrowForward), 'Redo', self)
+        redoAction.setShortcut(QtGui.QKeySequence.Redo)
+        self.editToolbar.addAction(redoAction)
+        redoAction.triggered.connect(lambda x: self.manual_window.mmask.redo())
+
         saveAction = QtWidgets.QAction(QtGui.QIcon('assets/save.png'), 'Save', self)
         self.editToolbar.addAction(saveAction)
         saveAction.triggered.connect(self.manual_window.mmask.save_image)
@@ -516,15 +949,15 @@ class MainWindow(QtWidgets.QMainWindow):
             self.manual_window.mmask.mouseMoveEvent(moved_evt)
 
 def application():
+    # heavy libraries (pydicom, nibabel, pandas, PIL, h5py) are imported by the
+    # features that use them, so only Qt and numpy load before the first window
     os.chdir(Path(__file__).parent)
-    shutil.rmtree(Path(os.path.expanduser('~')) / '.MammArea', ignore_errors=True)
-    os.makedirs(Path(os.path.expanduser('~')) / '.MammArea', exist_ok=True)
     app = QtWidgets.QApplication(sys.argv)
     app.setWindowIcon(QtGui.QIcon('dgl.ico'))
     window = MainWindow(app.primaryScreen().availableGeometry())
     window.show()
     app.exec()
-    shutil.rmtree(Path(os.path.expanduser('~')) / '.MammArea')
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     application()
@@ -0,0 +1,68 @@
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+
+CHUNK = 1 << 16
+
+
+def available():
+    # checked without importing h5py, which is slow to load
+    return importlib.util.find_spec('h5py') is not None
+
+
+class MaskStore():
+    # one HDF5 file holding every mask as a chunked, lzf-compressed, bit-packed
+    # dataset under /masks/<SOPInstanceUID>, with spacing and study metadata as
+    # attributes; only the process that owns the store writes to it
+    def __init__(self, path, mode='a'):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('h5py is required to write a single-file mask store')
+        self.path = Path(path)
+        self.f = h5py.File(self.path, mode)
+        self.masks = self.f.require_group('masks')
+
+    def name(self, header):
+        return header.sop_uid or header.fingerprint
+
+    def put(self, header, area, packed):
+        bits, rows, cols = packed
+        name = self.name(header)
+        if name in self.masks:
+            del self.masks[name]
+        data = np.frombuffer(bits, dtype=np.uint8)
+        ds = self.masks.create_dataset(name, data=data, chunks=(min(CHUNK, len(data)),),
+                                       compression='lzf', shuffle=False)
+        ds.attrs['shape'] = (rows, cols)
+        ds.attrs['spacing'] = (header.spacing_x, header.spacing_y)
+        ds.attrs['area'] = area
+        for key in ('patient_id', 'accession', 'projection', 'path'):
+            ds.attrs[key] = getattr(header, key) or ''
+
+    def __contains__(self, sop_uid):
+        return sop_uid in self.masks
+
+    def keys(self):
+        return list(self.masks.keys())
+
+    def meta(self, sop_uid):
+        return dict(self.masks[sop_uid].attrs)
+
+    def get(self, sop_uid):
+        ds = self.masks[sop_uid]
+        rows, cols = ds.attrs['shape']
+        return np.unpackbits(ds[()], count=rows * cols).view(bool).reshape(rows, cols)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,167 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import archives
+import timing
+
+MAX_BYTES = 512 << 20
+# uncompressed syntaxes whose pixel data can be memory-mapped as is (explicit
+# and implicit VR little endian); pydicom itself is imported on first use
+NATIVE = ('1.2.840.10008.1.2.1', '1.2.840.10008.1.2')
+
+
+class PixelCache():
+    # decoded pixel arrays keyed by file identity, least recently used evicted first;
+    # arrays are returned read-only because every caller shares the same copy
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, decode):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        arr = decode()
+        arr.flags.writeable = False
+        with self.lock:
+            if key not in self.entries and arr.nbytes <= self.max_bytes:
+                self.entries[key] = arr
+                self.nbytes += arr.nbytes
+                while self.nbytes > self.max_bytes:
+                    _, old = self.entries.popitem(last=False)
+                    self.nbytes -= old.nbytes
+                    self.evictions += 1
+        return arr
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.nbytes}
+
+
+CACHE = PixelCache()
+
+
+def file_key(path):
+    stat = archives.stat(path) if archives.is_member(path) else os.stat(path)
+    return (str(path), stat.st_size, stat.st_mtime_ns)
+
+
+def open_dataset(path, **kwargs):
+    # archive members are read in place, pixel data only when it is decoded
+    import pydicom
+    if archives.is_member(path):
+        return pydicom.dcmread(archives.open_member(path), **kwargs)
+    return pydicom.dcmread(path, **kwargs)
+
+
+def dataset_key(dcm):
+    path = getattr(dcm, 'filename', None)
+    if isinstance(path, (str, os.PathLike)) and os.path.exists(path):
+        return file_key(path)
+    return None
+
+
+def frame_count(dcm):
+    return int(dcm.get('NumberOfFrames') or 1)
+
+
+def decode(dcm):
+    # multi-frame objects are represented by their central frame only
+    frames = frame_count(dcm)
+    if frames > 1:
+        return middle_frame(dcm, frames)
+    key = dataset_key(dcm)
+    if key is None:
+        # in-memory datasets have no stable identity to cache under
+        CACHE.misses += 1
+        return dcm.pixel_array
+    return CACHE.get(key, lambda: dcm.pixel_array)
+
+
+def middle_frame(dcm, frames):
+    from pydicom.pixels import iter_pixels
+    index = frames // 2
+    key = dataset_key(dcm)
+    if key is None:
+        CACHE.misses += 1
+        return dcm.pixel_array[index]
+    return CACHE.get(key + (index,), lambda: next(iter_pixels(dcm.filename, indices=[index])))
+
+
+def _memmap(path):
+    # the frames of uncompressed, little endian, single sample data as a
+    # read-only (frames, rows, cols) view of the file, or None
+    if archives.is_member(path):
+        return None
+    dcm = open_dataset(path, defer_size=1024)
+    if dcm.file_meta.get('TransferSyntaxUID') not in NATIVE or dcm.get('SamplesPerPixel', 1) != 1:
+        return None
+    bits = dcm.BitsAllocated
+    if bits not in (8, 16) or (dcm.PixelRepresentation == 1 and dcm.BitsStored != bits):
+        return None
+    elem = dcm.get_item(0x7FE00010, keep_deferred=True)
+    if elem is None or elem.value_tell is None:
+        return None
+    dtype = np.dtype(f'<{"i" if dcm.PixelRepresentation else "u"}{bits // 8}')
+    shape = (frame_count(dcm), dcm.Rows, dcm.Columns)
+    if elem.length < np.prod(shape) * dtype.itemsize:
+        return None
+    arr = np.memmap(path, dtype=dtype, mode='r', offset=elem.value_tell, shape=shape)
+    # bits above BitsStored may hold overlays; pydicom masks them, so do we
+    mask = (1 << dcm.BitsStored) - 1 if dcm.BitsStored != bits else None
+    return arr, mask
+
+
+def iter_frames(path, timings=timing.NULL):
+    # yields one 2D frame at a time so a tomosynthesis volume is never held
+    # whole: uncompressed data is read through a memory map, anything else is
+    # decoded frame by frame
+    from pydicom.pixels import iter_pixels
+    with timings.stage('read'):
+        mapped = _memmap(path)
+    if timings is not timing.NULL:
+        timings.bytes_read += file_key(path)[1]
+    if mapped is not None:
+        arr, mask = mapped
+        for frame in arr:
+            with timings.stage('decode'):
+                frame = frame & mask if mask is not None else np.array(frame)
+            yield frame
+        return
+    frames = iter_pixels(archives.open_member(path) if archives.is_member(path) else path)
+    while True:
+        with timings.stage('decode'):
+            frame = next(frames, None)
+        if frame is None:
+            return
+        yield frame
+
+
+def load(path, timings=timing.NULL):
+    key = file_key(path)
+
+    def read():
+        with timings.stage('read'):
+            dcm = open_dataset(path)
+        if timings is not timing.NULL:
+            timings.bytes_read += key[1]
+        with timings.stage('decode'):
+            return dcm.pixel_array
+
+    return CACHE.get(key, read)
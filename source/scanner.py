@@ -0,0 +1,145 @@
+import os
+import queue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import archives
+import dcmindex
+
+WORKERS = 16
+LISTERS = 4
+PREAMBLE = 128
+
+
+class Walk():
+    # every regular file below root, whatever its extension, with its stat;
+    # root may also be a single file such as an archive. Folders are listed on
+    # a few threads, each queueing its subfolders itself, so listing runs ahead
+    # of whoever iterates; `found` counts the files listed so far and is final
+    # once iteration ends
+    def __init__(self, root, workers=LISTERS):
+        self.root = os.fspath(root)
+        self.workers = workers
+        self.found = 0
+
+    def __iter__(self):
+        if os.path.isfile(self.root):
+            self.found = 1
+            yield self.root, os.stat(self.root)
+            return
+        listed = queue.Queue()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        def visit(folder):
+            # the folder's entry goes on the queue before any subfolder is
+            # submitted, so its subfolders are counted before they can report
+            folders, files = [], []
+            try:
+                folders, files = _list(folder)
+            finally:
+                listed.put((len(folders), files))
+            for sub in folders:
+                try:
+                    pool.submit(visit, sub)
+                except RuntimeError:
+                    # the pool was shut down because iteration stopped early
+                    return
+
+        try:
+            pool.submit(visit, self.root)
+            remaining = 1
+            while remaining:
+                folders, files = listed.get()
+                remaining += folders - 1
+                self.found += len(files)
+                yield from files
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _list(folder):
+    # (subfolders, files with their stat) of one folder, sorted by name
+    folders, files = [], []
+    try:
+        entries = sorted(os.scandir(folder), key=lambda e: e.name)
+    except OSError:
+        return folders, files
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file():
+                files.append((entry.path, entry.stat()))
+        except OSError:
+            pass
+    return folders, files
+
+
+def is_dicom(path):
+    # Part 10 files carry 'DICM' after a 128 byte preamble; bare datasets
+    # without it are only trusted when they use the .dcm extension
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(PREAMBLE + 4)
+    except OSError:
+        return False
+    return head[PREAMBLE:] == b'DICM' or path.lower().endswith('.dcm')
+
+
+def read(path):
+    if not is_dicom(path):
+        return dcmindex.unreadable(path)
+    return dcmindex.read_header(path)
+
+
+def iter_headers(files, index=None, workers=WORKERS, cancel=None):
+    # yields (path, header) for every file as soon as it is known, in completion
+    # order; the index is only touched from the calling thread. An archive
+    # yields its DICOM members (path 'archive::member') followed by itself
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        try:
+            for path, stat in files:
+                if cancel is not None and cancel.is_set():
+                    return
+                header = index.get(path, stat) if index is not None else None
+                if header is not None:
+                    index.hits += 1
+                    if archives.is_archive(path):
+                        for member in index.get_prefixed(archives.member_path(path, ''), stat):
+                            yield member.path, member
+                    yield path, header
+                    continue
+                if archives.is_archive(path):
+                    pending[pool.submit(archives.read_headers, path)] = (path, stat)
+                else:
+                    pending[pool.submit(read, path)] = (path, stat)
+                if len(pending) >= workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from _collect(done, pending, index)
+            while pending:
+                if cancel is not None and cancel.is_set():
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from _collect(done, pending, index)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _collect(done, pending, index):
+    for future in done:
+        path, stat = pending.pop(future)
+        header = future.result()
+        if archives.is_archive(path):
+            if index is not None:
+                index.forget_prefixed(archives.member_path(path, ''))
+            for member in header:
+                if index is not None:
+                    index.put(member, stat)
+                yield member.path, member
+            # the archive's own row is stored last and marks its members complete
+            header = dcmindex.unreadable(path)
+        if index is not None:
+            index.misses += 1
+            index.put(header, stat)
+        yield path, header
@@ -0,0 +1,166 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+import writer
+
+MANIFEST = 'shard.json'
+
+
+def key(header):
+    return header.sop_uid or header.fingerprint
+
+
+def shard_of(header, count):
+    # stable across machines and Python versions, unlike hash()
+    digest = hashlib.blake2b(key(header).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def select(headers, index, count):
+    if not 0 <= index < count:
+        raise ValueError(f'shard index {index} is not in 0..{count - 1}')
+    return [h for h in headers if shard_of(h, count) == index]
+
+
+def folder_name(index, count):
+    return f'shard_{index:03d}_of_{count:03d}'
+
+
+def store_path(path, index, count):
+    path = Path(path)
+    return path.with_name(f'{path.stem}.{folder_name(index, count)}{path.suffix}')
+
+
+def cohort_id(headers):
+    keys = sorted({key(h) for h in headers})
+    h = hashlib.blake2b(digest_size=16)
+    for k in keys:
+        h.update(f'{k}\n'.encode())
+    return h.hexdigest(), len(keys)
+
+
+def _dump(folder, manifest):
+    path = Path(folder) / MANIFEST
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+
+def write_manifest(folder, headers, shard, index, count):
+    # every shard scans the whole cohort, so each manifest can record what the
+    # merged table must contain; entries follow the row order of areas.csv
+    cohort, size = cohort_id(headers)
+    _dump(folder, {'index': index, 'count': count, 'cohort': cohort, 'cohort_size': size, 'complete': False,
+                   'entries': [[h.path, key(h), h.frames or 1] for h in shard]})
+
+
+def mark_complete(folder):
+    with open(Path(folder) / MANIFEST) as f:
+        manifest = json.load(f)
+    manifest['complete'] = True
+    _dump(folder, manifest)
+
+
+def _read_csv(path):
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    return rows[0], rows[1:]
+
+
+def _frame_groups(rows, frame_col):
+    # frame rows of consecutive objects, split where the frame index restarts
+    groups = []
+    for row in rows:
+        if row[frame_col] == '0' or not groups:
+            groups.append([])
+        groups[-1].append(row)
+    return iter(groups)
+
+
+def merge(root, out=None):
+    # combines shard_*_of_*/ folders below root into one areas.csv (and
+    # frames.csv) sorted by path; raises ValueError on missing, incomplete or
+    # mismatched shards and on any gap, and keeps one row per instance
+    root = Path(root)
+    out = root if out is None else Path(out)
+    manifests = []
+    for path in sorted(root.glob(f'shard_*_of_*/{MANIFEST}')):
+        with open(path) as f:
+            manifests.append((path.parent, json.load(f)))
+    if not manifests:
+        raise ValueError(f'no shard folders found in {root}')
+    first = manifests[0][1]
+    for folder, m in manifests:
+        if (m['count'], m['cohort']) != (first['count'], first['cohort']):
+            raise ValueError(f'{folder.name} was run on a different cohort or shard count')
+        if not m['complete']:
+            raise ValueError(f'{folder.name} has not finished')
+    indices = sorted(m['index'] for _, m in manifests)
+    if indices != list(range(first['count'])):
+        missing = sorted(set(range(first['count'])) - set(indices))
+        raise ValueError(f'shards missing or repeated: expected 0..{first["count"] - 1}, missing {missing}')
+
+    columns = frame_columns = None
+    rows = {}
+    frames = {}
+    for folder, m in manifests:
+        columns, table = _read_csv(folder / 'areas.csv')
+        if len(table) != len(m['entries']):
+            raise ValueError(f'{folder.name}: {len(table)} rows for {len(m["entries"])} images')
+        groups = None
+        if (folder / 'frames.csv').exists():
+            frame_columns, frame_rows = _read_csv(folder / 'frames.csv')
+            groups = _frame_groups(frame_rows, frame_columns.index('Frame'))
+        for (path, k, n), row in zip(m['entries'], table):
+            group = next(groups, []) if groups is not None and n > 1 else []
+            if k in rows:
+                continue
+            rows[k] = (path, row)
+            frames[k] = group
+    if len(rows) != first['cohort_size']:
+        raise ValueError(f'{len(rows)} images merged, {first["cohort_size"]} expected')
+
+    os.makedirs(out, exist_ok=True)
+    order = sorted(rows, key=lambda k: rows[k][0])
+    with open(out / 'areas.csv', 'w', newline='') as f:
+        w = csv.writer(f, lineterminator='\n')
+        w.writerow(columns)
+        w.writerows(rows[k][1] for k in order)
+    if frame_columns is not None:
+        with open(out / 'frames.csv', 'w', newline='') as f:
+            w = csv.writer(f, lineterminator='\n')
+            w.writerow(frame_columns)
+            for k in order:
+                w.writerows(frames[k])
+    return len(order)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge the outputs of a sharded batch run into one table')
+    parser.add_argument('root', help='folder holding the shard_*_of_* result folders')
+    parser.add_argument('--out', default=None, help='where to write areas.csv (default: root)')
+    parser.add_argument('--excel', action='store_true', help='also export areas.xlsx')
+    parser.add_argument('--parquet', action='store_true', help='also export areas.parquet')
+    args = parser.parse_args(argv)
+    out = Path(args.out or args.root)
+    try:
+        n = merge(args.root, out)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f'{n} images merged into {out / "areas.csv"}', file=sys.stderr)
+    if args.excel or args.parquet:
+        writer.export(out / 'areas.csv',
+                      out / 'areas.xlsx' if args.excel else None,
+                      out / 'areas.parquet' if args.parquet else None)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import numpy as np
+
+# With step=1 the Otsu threshold is computed on the same unit-width integer
+# histogram skimage.filters.threshold_otsu builds for integer images, so the
+# threshold, and therefore the area, is identical; benchmarks/bench.py checks
+# this whenever skimage is installed. A step > 1 estimates the histogram from
+# every step-th row and column; the resulting area is expected to stay within
+# AREA_TOLERANCE (relative) of the full-resolution one.
+AREA_TOLERANCE = 0.005
+FLOAT_BINS = 256
+
+
+def histogram(raw, step=1):
+    # returns (counts, centers); integer data gets one bin per grey level
+    if step > 1:
+        raw = raw[::step, ::step]
+    if np.issubdtype(raw.dtype, np.integer):
+        lo = int(raw.min())
+        hi = int(raw.max())
+        if lo >= 0 and raw.dtype.itemsize <= 2:
+            counts = np.bincount(raw.ravel(), minlength=hi + 1)[lo:]
+        else:
+            counts = np.bincount(raw.ravel().astype(np.intp) - lo, minlength=hi - lo + 1)
+        return counts, np.arange(lo, hi + 1)
+    counts, edges = np.histogram(raw, FLOAT_BINS)
+    return counts, (edges[:-1] + edges[1:]) / 2
+
+
+def otsu(counts, centers):
+    # the arithmetic of skimage.filters.threshold_otsu step for step, float32
+    # counts included, so ties on flat valleys resolve to the same grey level
+    if len(counts) == 1:
+        return centers[0]
+    counts = counts.astype(np.float32, copy=False)
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * centers) / weight1
+    mean2 = (np.cumsum((counts * centers)[::-1]) / weight2[::-1])[::-1]
+    variance = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return centers[np.argmax(variance)]
+
+
+def triangle(counts, centers):
+    nbins = len(counts)
+    peak = int(np.argmax(counts))
+    nonzero = np.flatnonzero(counts)
+    low, high = int(nonzero[0]), int(nonzero[-1])
+    flip = peak - low < high - peak
+    if flip:
+        counts = counts[::-1]
+        low = nbins - high - 1
+        peak = nbins - peak - 1
+    width = peak - low
+    if width == 0:
+        return centers[peak if not flip else nbins - peak - 1]
+    x = np.arange(width)
+    y = counts[x + low]
+    height = float(counts[peak])
+    norm = np.sqrt(height ** 2 + width ** 2)
+    level = int(np.argmax(height / norm * x - width / norm * y)) + low
+    if flip:
+        level = nbins - level - 1
+    return centers[level]
+
+
+def li(counts, centers, tolerance=None):
+    counts = counts.astype(np.float64)
+    present = centers[counts > 0]
+    if len(present) == 1:
+        return present[0]
+    if tolerance is None:
+        tolerance = np.min(np.diff(present)) / 2
+    # shift to a zero minimum, as the Li criterion takes logs of the class means
+    shift = present[0]
+    x = centers - shift
+    t = np.sum(counts * x) / np.sum(counts)
+    t_prev = t + 2 * tolerance
+    while abs(t - t_prev) > tolerance:
+        t_prev = t
+        fore = x > t
+        n_fore, n_back = counts[fore].sum(), counts[~fore].sum()
+        if n_fore == 0 or n_back == 0:
+            break
+        mean_fore = (counts[fore] * x[fore]).sum() / n_fore
+        mean_back = (counts[~fore] * x[~fore]).sum() / n_back
+        if mean_back == 0:
+            break
+        t = (mean_back - mean_fore) / (np.log(mean_back) - np.log(mean_fore))
+    return t + shift
+
+
+METHODS = {'otsu': otsu, 'triangle': triangle, 'li': li}
+
+
+def threshold(raw, method='otsu', step=1):
+    return METHODS[method](*histogram(raw, step))
+
+
+def mask(raw, method='otsu', step=1):
+    return raw > threshold(raw, method, step)
@@ -0,0 +1,97 @@
+import csv
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+class Timings():
+    # stage durations and I/O volume for one image
+    def __init__(self):
+        self.seconds = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - t0
+
+    def as_dict(self):
+        return dict(self.seconds, bytes_read=self.bytes_read, bytes_written=self.bytes_written)
+
+
+class NullTimings():
+    # stands in for Timings when instrumentation is off
+    bytes_read = 0
+    bytes_written = 0
+
+    def stage(self, name, count=None):
+        return nullcontext()
+
+    def as_dict(self):
+        return None
+
+
+NULL = NullTimings()
+
+
+class RunReport():
+    def __init__(self):
+        self.images = []
+        self.totals = {}
+        self.counts = {}
+        self.cached = 0
+
+    @contextmanager
+    def stage(self, name, count=None):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_total(name, time.perf_counter() - t0, count)
+
+    def add_total(self, name, seconds, count=None):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        if count is not None:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def add_image(self, path, timings):
+        self.images.append((str(path), timings))
+
+    def summary(self):
+        stages = {}
+        for _, timings in self.images:
+            for name, value in timings.items():
+                if not name.startswith('bytes_'):
+                    stages.setdefault(name, []).append(value)
+        per_image = {}
+        for name, values in stages.items():
+            values = np.array(values)
+            per_image[name] = {'count': len(values), 'total': float(values.sum()), 'mean': float(values.mean()),
+                               'max': float(values.max())}
+            for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                per_image[name][f'p{p}'] = float(v)
+        return {'images_computed': len(self.images), 'images_cached': self.cached,
+                'bytes_read': sum(t.get('bytes_read', 0) for _, t in self.images),
+                'bytes_written': sum(t.get('bytes_written', 0) for _, t in self.images),
+                'per_image': per_image,
+                'run': {name: {'seconds': s, 'count': self.counts.get(name)} for name, s in self.totals.items()}}
+
+    def write(self, folder, name='run_report'):
+        folder = Path(folder)
+        with open(folder / f'{name}.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        columns = sorted({k for _, t in self.images for k in t})
+        with open(folder / f'{name}.csv', 'w', newline='') as f:
+            out = csv.writer(f)
+            out.writerow(['path'] + columns)
+            for path, timings in self.images:
+                out.writerow([path] + [timings.get(c, '') for c in columns])
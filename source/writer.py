@@ -0,0 +1,131 @@
+import csv
+import io
+import json
+import os
+from pathlib import Path
+
+EXCEL_MAX_ROWS = 1048575
+
+
+class ResultWriter():
+    # rows are appended to a CSV in batches; after every batch the file is synced
+    # and a checkpoint records how many rows (and bytes) are safely on disk, so an
+    # interrupted run over the same inputs resumes after the last complete batch
+    def __init__(self, path, columns, inputs_id, batch_size=256, on_sync=None, sidecar=None):
+        # sidecar is an optional (path, columns) CSV of rows that belong to the
+        # main ones (e.g. per-frame areas); it is written and synced together
+        # with them and its offset kept in the same checkpoint
+        self.path = Path(path)
+        self.on_sync = on_sync
+        self.checkpoint = self.path.with_name(self.path.name + '.checkpoint.json')
+        self.columns = columns
+        self.inputs_id = inputs_id
+        self.batch_size = batch_size
+        self.pending = []
+        self.done = 0
+        self.side = None
+        self.side_pending = []
+        self.side_columns = None
+        if sidecar is not None:
+            side_path, self.side_columns = sidecar
+            side_path = Path(side_path)
+
+        state = self._load_checkpoint()
+        if state is not None and self.path.exists() and (sidecar is None or side_path.exists()):
+            self.done = state['rows']
+            self.f = open(self.path, 'r+b')
+            self.f.truncate(state['offset'])
+            self.f.seek(state['offset'])
+            if sidecar is not None:
+                self.side = open(side_path, 'r+b')
+                self.side.truncate(state['sidecar'])
+                self.side.seek(state['sidecar'])
+        else:
+            self.f = open(self.path, 'wb')
+            self.f.write(self._encode([columns]))
+            if sidecar is not None:
+                self.side = open(side_path, 'wb')
+                self.side.write(self._encode([self.side_columns]))
+            self._sync()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (state.get('inputs') != self.inputs_id or state.get('columns') != self.columns
+                or state.get('sidecar_columns') != self.side_columns):
+            return None
+        return state
+
+    def _encode(self, rows):
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator='\n').writerows(rows)
+        return buf.getvalue().encode('utf-8')
+
+    def _sync(self):
+        # anything the rows depend on (e.g. a mask store) is flushed first
+        if self.on_sync is not None:
+            self.on_sync()
+        state = {'inputs': self.inputs_id, 'columns': self.columns, 'rows': self.done,
+                 'sidecar_columns': self.side_columns}
+        if self.side is not None:
+            self.side.flush()
+            os.fsync(self.side.fileno())
+            state['sidecar'] = self.side.tell()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        state['offset'] = self.f.tell()
+        tmp = self.checkpoint.with_name(self.checkpoint.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+
+    def write(self, row):
+        self.pending.append([row[c] for c in self.columns])
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def write_sidecar(self, row):
+        # call before writing the main row the sidecar rows belong to
+        self.side_pending.append([row[c] for c in self.side_columns])
+
+    def flush(self):
+        if self.pending or self.side_pending:
+            if self.side_pending:
+                self.side.write(self._encode(self.side_pending))
+                self.side_pending = []
+            self.f.write(self._encode(self.pending))
+            self.done += len(self.pending)
+            self.pending = []
+            self._sync()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        if self.side is not None:
+            self.side.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_table(csv_path):
+    # pandas is imported on first export, not when the GUI starts
+    import pandas as pd
+    return pd.read_csv(csv_path, dtype={'IDPACS': str, 'Accession Number': str, 'Projection': str})
+
+
+def export(csv_path, excel=None, parquet=None):
+    df = read_table(csv_path)
+    if excel is not None:
+        if len(df) > EXCEL_MAX_ROWS:
+            raise ValueError(f'{len(df)} rows do not fit in an Excel sheet, use the CSV or Parquet output')
+        df.to_excel(excel)
+    if parquet is not None:
+        df.to_parquet(parquet, index=False)
+    return df